@@ -0,0 +1,248 @@
+import argparse
+import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Iterator, Type, Iterable
+
+from boardtt.card_type import CardType
+from boardtt.config import Config
+from boardtt.fingerprint import CardDeduplicator
+from boardtt.journal import ProgressJournal
+from boardtt.logger import LOGGER
+from boardtt.manager import ImageProcessingManager
+from boardtt.sources import SCAN_SUFFIXES, ScanPage, iter_scan_pages
+
+
+def get_arg_parser(prog: str | None = None) -> argparse.ArgumentParser:
+    """Возвращает разборщик аргументов командной строки для скриптов,
+    обрабатывающих директорию сканов (см. `examples`)."""
+    arg_parser = argparse.ArgumentParser(prog=prog)
+    arg_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue an interrupted run from its progress journal",
+    )
+    arg_parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="attempts per scan or card before it is quarantined",
+    )
+    arg_parser.add_argument("--workers", type=int, default=1, help="processes per scan")
+    arg_parser.add_argument(
+        "--page-workers",
+        type=int,
+        default=1,
+        help="scans (pages of multi-page scans) processed in parallel",
+    )
+    return arg_parser
+
+
+def process_page(
+    page: ScanPage,
+    config: Config,
+    card_types: tuple[Type[CardType], ...],
+    journal: ProgressJournal,
+    dedup: CardDeduplicator | None = None,
+    workers: int = 1,
+) -> None:
+    """Обрабатывает страницу скана, отмечая ход обработки в журнале.
+    Страница, обработка которой не удалась `max_attempts` раз, помещается в карантин."""
+    scan_journal = journal.scan(page.name)
+    state = scan_journal.state
+
+    if state["done"] or state["quarantined"]:
+        LOGGER.info("Skipping %s, already processed" % page.name)
+        return
+
+    while True:
+        if state["starts"] >= journal.max_attempts:
+            # Предыдущие попытки не завершились ни успехом, ни ошибкой -
+            # скорее всего, процесс падал на этом скане.
+            LOGGER.error(
+                "%s quarantined after %s attempts" % (page.name, journal.max_attempts)
+            )
+            scan_journal.record("quarantined")
+            return
+
+        state = scan_journal.record("start")
+
+        try:
+            ImageProcessingManager(
+                config,
+                page,
+                card_types,
+                dedup=dedup,
+                workers=workers,
+                journal=scan_journal,
+            ).process()
+
+        except Exception as e:
+            LOGGER.exception("Processing of %s failed" % page.name)
+            state = scan_journal.record("failed", error=str(e) or repr(e))
+
+        else:
+            scan_journal.record("done")
+            return
+
+
+def iter_directory_pages(
+    source_dir: str | os.PathLike, journal: ProgressJournal, dpi: int = 300
+) -> Iterator[ScanPage]:
+    """Перебирает страницы всех сканов директории. Скан, который не удаётся
+    прочитать, помещается в карантин."""
+    scans = sorted(
+        f
+        for f in Path(source_dir).iterdir()
+        if f.is_file() and f.suffix.lower() in SCAN_SUFFIXES
+    )
+
+    for scan in scans:
+        scan_journal = journal.scan(scan.name)
+        if scan_journal.state["quarantined"]:
+            continue
+
+        try:
+            pages = list(iter_scan_pages(scan, dpi))
+        except Exception as e:
+            LOGGER.exception("Unable to read %s" % scan)
+            scan_journal.record("quarantined", error=str(e) or repr(e))
+            continue
+
+        yield from pages
+
+
+def _process_page_in_worker(
+    page: ScanPage,
+    source_dir: str | os.PathLike,
+    max_attempts: int,
+    config: Config,
+    card_types: tuple[Type[CardType], ...],
+    dedup: CardDeduplicator | None,
+    workers: int,
+) -> None:
+    """Обрабатывает страницу в дочернем процессе. Журнал читается из файла:
+    только там есть записи других процессов, в том числе упавших."""
+    journal = ProgressJournal(source_dir, max_attempts=max_attempts)
+    process_page(page, config, card_types, journal, dedup, workers)
+
+
+def _process_pages_parallel(
+    pages: Iterator[ScanPage],
+    journal: ProgressJournal,
+    page_workers: int,
+    *args,
+) -> None:
+    """Обрабатывает страницы в `page_workers` процессах.
+
+    Если процесс падает (например, его убивает OOM killer), пул перестаёт
+    работать: страницы, обрабатывавшиеся в нём, отмечаются в журнале
+    неудачными и обрабатываются заново в новом пуле - по одной, чтобы
+    следующее падение указало на виновную страницу. Страница, на которой
+    процессы падают раз за разом, помещается в карантин (см. `process_page`).
+    """
+    retries = deque()
+    suspects = set()
+
+    while True:
+        in_flight = {}
+        crashed = []
+
+        with ProcessPoolExecutor(page_workers) as executor:
+            while not crashed:
+                limit = 1 if suspects else page_workers * 2
+                if len(in_flight) < limit:
+                    page = retries.popleft() if retries else next(pages, None)
+                    if page is not None:
+                        future = executor.submit(
+                            _process_page_in_worker,
+                            page,
+                            os.path.dirname(journal.path),
+                            journal.max_attempts,
+                            *args,
+                        )
+                        in_flight[future] = page
+                        continue
+
+                if not in_flight:
+                    break
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = in_flight.pop(future)
+                    try:
+                        future.result()
+                    except BrokenProcessPool:
+                        crashed.append(page)
+                    else:
+                        suspects.discard(page)
+
+            # Остальные задания упавшего пула тоже не будут выполнены.
+            crashed.extend(in_flight.values())
+
+        if not crashed:
+            return
+
+        LOGGER.error(
+            "Page worker process died, retrying %s page(s): %s"
+            % (len(crashed), ", ".join(page.name for page in crashed))
+        )
+        for page in crashed:
+            journal.scan(page.name).record("failed", error="Worker process died")
+            retries.append(page)
+            suspects.add(page)
+
+
+def process_directory(
+    source_dir: str | os.PathLike,
+    config: Config,
+    card_types: Iterable[Type[CardType]],
+    resume: bool = False,
+    max_attempts: int = 3,
+    dedup: CardDeduplicator | None = None,
+    workers: int = 1,
+    page_workers: int = 1,
+) -> ProgressJournal:
+    """Обрабатывает все сканы директории, ведя журнал хода обработки.
+    Страницы многостраничных сканов (TIFF, PDF) обрабатываются как отдельные сканы.
+
+    Если `resume` истинно, обработка продолжается по журналу прерванного запуска:
+    обработанные сканы и карты пропускаются. Иначе журнал начинается заново.
+
+    Скан или карта, обработка которых не удалась `max_attempts` раз (в том числе
+    из-за падения процесса на этом скане), помещаются в карантин и пропускаются,
+    а обработка остальных продолжается.
+
+    При `page_workers` > 1 страницы обрабатываются в нескольких процессах,
+    каждый из которых сам декодирует свою страницу. Одновременно декодируется
+    не больше `page_workers` страниц. Копии карт (`dedup`) в этом режиме
+    ищутся только в пределах страницы. Падение процесса не прерывает обработку:
+    страницы упавшего процесса обрабатываются заново.
+
+    Возвращает журнал обработки.
+    """
+    card_types = tuple(card_types)
+    journal = ProgressJournal(source_dir, max_attempts=max_attempts, reset=not resume)
+    pages = iter_directory_pages(source_dir, journal, config.image_dpi)
+
+    if page_workers > 1:
+        _process_pages_parallel(
+            pages, journal, page_workers, config, card_types, dedup, workers
+        )
+
+        # Записи дочерних процессов есть только в файле журнала.
+        journal = ProgressJournal(source_dir, max_attempts=max_attempts)
+
+    else:
+        for page in pages:
+            process_page(page, config, card_types, journal, dedup, workers)
+
+    quarantined = journal.get_quarantined()
+    if quarantined:
+        LOGGER.warning(
+            "Quarantined (see %s):\n  %s" % (journal.path, "\n  ".join(quarantined))
+        )
+
+    return journal
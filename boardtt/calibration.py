@@ -0,0 +1,274 @@
+import os
+import shlex
+import time
+from typing import Type
+
+from PIL import Image, ImageDraw
+
+from boardtt.card_area import CardArea
+from boardtt.card_type import CardType
+from boardtt.config import Config
+from boardtt.exceptions import TesseractException
+from boardtt.logger import LOGGER
+from boardtt.marker import CardsData
+
+
+class CalibrationSession:
+    """Подбор координат регионов типа карты.
+
+    Скан декодируется и режется на карты один раз; уменьшенные копии карт
+    хранятся в памяти. Рамки регионов рисуются поверх уменьшенных копий
+    на листе предпросмотра без распознавания, поэтому каждое изменение
+    координат отображается за миллисекунды. Распознаётся только
+    настраиваемый регион одной карты и только по запросу (`recognize()`).
+
+    Координаты регионов меняются в рабочих копиях описаний, класс типа карты
+    не изменяется. Итоговые описания для вставки в класс возвращает `get_code()`.
+
+    :param config: Конфигурация скана
+    :param cards: Список с данными карт скана
+    :param card_type: Настраиваемый тип карты
+    :param thumb_width: Ширина уменьшенной копии карты на листе предпросмотра, в пикселах
+    """
+
+    colors = ("#e6194b", "#3cb44b", "#4363d8", "#f58231", "#911eb4", "#42d4f4")
+    highlight_color = "#ffe119"
+
+    def __init__(
+        self,
+        config: Config,
+        cards: CardsData,
+        card_type: Type[CardType],
+        thumb_width: int = 240,
+    ):
+        self.config = config
+        self.cards = cards
+        self.card_type = card_type
+        self.areas: dict[str, CardArea] = dict(card_type.get_area_definitions())
+
+        self.scale = thumb_width / config.card_width_px
+        thumb_size = (thumb_width, round(config.card_height_px * self.scale))
+        self.thumbs = [
+            card["img"].convert("RGB").resize(thumb_size, Image.Resampling.BOX)
+            for card in cards
+        ]
+
+    def set_area(self, name: str, **params) -> CardArea:
+        """Задаёт параметры региона (`x`, `x1`, `y`, `y1` в миллиметрах, `rotate` и т.п.).
+        Если региона с таким именем нет, он создаётся.
+
+        :raises ValueError: если правая или нижняя граница региона оказывается
+            левее или выше левой или верхней
+        """
+        area = self.areas.get(name)
+        if area is not None:
+            params = {**vars(area), **params}
+        area = CardArea(**params)
+
+        if area.x1 < area.x or area.y1 < area.y:
+            raise ValueError(
+                f"Area `{name}` would have negative size:"
+                f" x={area.x:g}, x1={area.x1:g}, y={area.y:g}, y1={area.y1:g}"
+            )
+
+        self.areas[name] = area
+        return area
+
+    def move_area(self, name: str, dx: float = 0, dy: float = 0) -> CardArea:
+        """Сдвигает регион на указанное количество миллиметров."""
+        area = self.areas[name]
+        return self.set_area(
+            name, x=area.x + dx, x1=area.x1 + dx, y=area.y + dy, y1=area.y1 + dy
+        )
+
+    def resize_area(self, name: str, dw: float = 0, dh: float = 0) -> CardArea:
+        """Изменяет ширину и высоту региона на указанное количество миллиметров."""
+        area = self.areas[name]
+        return self.set_area(name, x1=area.x1 + dw, y1=area.y1 + dh)
+
+    def _get_card_index(self, card: int) -> int:
+        """Возвращает индекс карты по её номеру (с 1).
+
+        :raises ValueError: если карты с таким номером нет
+        """
+        if not 1 <= card <= len(self.cards):
+            raise ValueError(f"No card #{card}, cards are numbered 1-{len(self.cards)}")
+        return card - 1
+
+    def render(
+        self,
+        cards: list[int] | None = None,
+        columns: int = 4,
+        highlight: str | None = None,
+    ) -> Image.Image:
+        """Возвращает лист предпросмотра: уменьшенные копии карт с рамками регионов.
+
+        :param cards: Номера (с 1) карт для листа. По умолчанию - все карты скана.
+        :param columns: Количество карт в ряду листа
+        :param highlight: Имя региона, выделяемого цветом и толщиной рамки
+        """
+        indexes = (
+            [self._get_card_index(num) for num in cards]
+            if cards
+            else range(len(self.thumbs))
+        )
+        thumb_width, thumb_height = self.thumbs[0].size
+        gap = 8
+        rows = (len(indexes) + columns - 1) // columns
+
+        sheet = Image.new(
+            "RGB",
+            (
+                columns * (thumb_width + gap) + gap,
+                rows * (thumb_height + gap) + gap,
+            ),
+            "white",
+        )
+
+        boxes = []
+        for num, (name, area) in enumerate(self.areas.items()):
+            box = tuple(
+                round(coord * self.scale) for coord in area.get_coords(self.config)
+            )
+            if name == highlight:
+                boxes.append((name, box, self.highlight_color, 3))
+            else:
+                boxes.append((name, box, self.colors[num % len(self.colors)], 1))
+
+        for pos, idx in enumerate(indexes):
+            left = gap + (pos % columns) * (thumb_width + gap)
+            top = gap + (pos // columns) * (thumb_height + gap)
+            sheet.paste(self.thumbs[idx], (left, top))
+
+            draw = ImageDraw.Draw(sheet)
+            for name, (x, y, x1, y1), color, width in boxes:
+                draw.rectangle(
+                    (left + x, top + y, left + x1, top + y1), outline=color, width=width
+                )
+                draw.text((left + x + 2, top + y + 1), name, fill=color)
+            draw.text((left + 2, top + 1), f"#{idx + 1}", fill="black")
+
+        return sheet
+
+    def save(self, path: str | os.PathLike, **kwargs) -> float:
+        """Сохраняет лист предпросмотра (см. `render()`).
+        Возвращает время отрисовки в миллисекундах."""
+        started = time.perf_counter()
+        sheet = self.render(**kwargs)
+        elapsed = (time.perf_counter() - started) * 1000
+        sheet.save(path)
+        return elapsed
+
+    def recognize(self, name: str, card: int = 1) -> tuple[str, float, Image.Image]:
+        """Распознаёт один регион одной карты.
+        Возвращает кортеж: (распознанный_текст, уверенность, изображение_для_распознания)
+
+        :param name: Имя региона
+        :param card: Номер карты (с 1)
+        """
+        handler = self.card_type(self.config, [])
+        text, img, _, confidence = handler.recognize_area(
+            self.cards[self._get_card_index(card)]["img"], self.areas[name]
+        )
+        return text, confidence, img
+
+    def get_code(self) -> str:
+        """Возвращает описания регионов для вставки в класс типа карты."""
+        defaults = vars(CardArea(0, 0, 0, 0))
+        lines = []
+        for name, area in self.areas.items():
+            args = [f"{getattr(area, attr):g}" for attr in ("x", "x1", "y", "y1")]
+            args.extend(
+                f"{attr}={value!r}"
+                for attr, value in vars(area).items()
+                if attr not in ("x", "x1", "y", "y1") and value != defaults[attr]
+            )
+            lines.append(f"{name} = CardArea({', '.join(args)})")
+        return "\n".join(lines)
+
+    def run(self, sheet_path: str | os.PathLike = "calibration.png") -> None:
+        """Интерактивный подбор координат в терминале.
+
+        После каждой команды лист предпросмотра перезаписывается в `sheet_path`
+        (большинство просмотрщиков изображений перечитывают изменившийся файл).
+
+        Команды::
+
+            set <регион> <x> <x1> <y> <y1>   задать координаты региона, мм
+            move <регион> <dx> <dy>          сдвинуть регион, мм
+            size <регион> <dw> <dh>          изменить размеры региона, мм
+            rotate <регион> <угол|none>      задать угол разворота текста
+            show [<номер карты> ...]         показывать только указанные карты
+            ocr <регион> [<номер карты>]     распознать регион
+            code                             вывести описания регионов
+            quit                             выйти
+        """
+        highlight = None
+        cards = None
+
+        while True:
+            try:
+                elapsed = self.save(sheet_path, cards=cards, highlight=highlight)
+            except (OSError, ValueError) as e:
+                print(f"Unable to save preview: {e!r}")
+            else:
+                LOGGER.info("Preview saved to %s (%.1f ms)" % (sheet_path, elapsed))
+
+            try:
+                command = shlex.split(input("calibrate> "))
+            except EOFError:
+                break
+            except ValueError as e:  # Незакрытая кавычка.
+                print(f"Invalid command: {e!r}")
+                continue
+
+            if not command:
+                continue
+
+            action, args = command[0], command[1:]
+
+            try:
+                if action == "quit":
+                    break
+
+                elif action == "set":
+                    highlight = args[0]
+                    x, x1, y, y1 = map(float, args[1:5])
+                    self.set_area(highlight, x=x, x1=x1, y=y, y1=y1)
+
+                elif action == "move":
+                    highlight = args[0]
+                    self.move_area(highlight, float(args[1]), float(args[2]))
+
+                elif action == "size":
+                    highlight = args[0]
+                    self.resize_area(highlight, float(args[1]), float(args[2]))
+
+                elif action == "rotate":
+                    highlight = args[0]
+                    rotate = None if args[1] == "none" else int(args[1])
+                    self.set_area(highlight, rotate=rotate)
+
+                elif action == "show":
+                    shown = [int(num) for num in args]
+                    for num in shown:
+                        self._get_card_index(num)
+                    cards = shown or None
+
+                elif action == "ocr":
+                    highlight = args[0]
+                    card = int(args[1]) if len(args) > 1 else (cards or [1])[0]
+                    text, confidence, _ = self.recognize(highlight, card)
+                    print(f"[{confidence:.0f}%] {text}")
+
+                elif action == "code":
+                    print(self.get_code())
+
+                else:
+                    print(f"Unknown command: {action}")
+
+            except (IndexError, KeyError, ValueError) as e:
+                print(f"Invalid command: {e!r}")
+
+            except TesseractException as e:
+                print(f"OCR failed: {e}")
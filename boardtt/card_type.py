@@ -1,18 +1,33 @@
 import json
 import os
 import re
+import threading
 from collections import OrderedDict
 
-from PIL import Image, ImageEnhance, ImageOps, ImageDraw, ImageFont
+from PIL import (
+    Image,
+    ImageChops,
+    ImageEnhance,
+    ImageFilter,
+    ImageOps,
+    ImageDraw,
+    ImageFont,
+)
 
 from boardtt.card_area import CardArea
 from boardtt.config import Config
 from boardtt.logger import LOGGER
 from boardtt.tesseract import TesseractAPI
+from boardtt.utils import atomic_write, save_image
+from boardtt.vector import get_card_svg
 
 
 RE_SPACES = re.compile(r"(\s)+", re.MULTILINE)
 
+# Кеш загруженных шрифтов. Свой для каждого потока, чтобы рабочие потоки
+# (см. `boardtt.server`) не делили между собой объекты FreeType.
+_FONTS_CACHE = threading.local()
+
 
 class CardType:
     """Тип карты характеризуется её внешним видом, а точнее расположением на ней
@@ -39,21 +54,193 @@ class CardType:
     # приведены к целому.
     norm_numeric = []
 
+    # Средняя уверенность распознавания слов (0-100), ниже которой регион
+    # распознаётся повторно с альтернативной подготовкой изображения.
+    min_confidence = 60
+
+    # Альтернативные способы подготовки изображения для повторного распознавания
+    # (имена методов), в порядке применения.
+    enhance_fallbacks = ("enhance_img_otsu", "enhance_img_adaptive")
+
+    # Сколько повторных распознаваний допустимо для одного региона.
+    max_ocr_retries = 2
+
+    # Форматы локализованных изображений карты:
+    # "png" - растровые оверлей (card_tr.png) и сведённое изображение (card_comp.png);
+    # "svg" - векторный оверлей с текстом (card_tr.svg), см. `boardtt.vector`.
+    overlay_formats = ("png",)
+
     DEBUG = False
 
-    def __init__(self, config: Config, cards, target_dir=None):
+    def __init__(self, config: Config, cards, target_dir=None, journal=None):
+        """
+        :param config: Конфигурация скана
+        :param cards: Список с данными карт скана
+        :param target_dir: Директория для материалов локализации
+        :param ScanJournal|None journal: Журнал хода обработки скана (см. `boardtt.journal`)
+        """
         self.config = config
         self.target_dir = target_dir
+        self.journal = journal
         self.cards = OrderedDict()
+        # Результаты обработки копий карт в пределах скана (см. `get_scan_results()`).
+        self.scan_results = {}
+
+        # Статистика распознавания: регионов распознано и сколько из них
+        # распознавалось повторно, всего повторных распознаваний.
+        self.ocr_areas = 0
+        self.ocr_retried_areas = 0
+        self.ocr_retries = 0
 
         for idx, card in enumerate(cards):
-            if self.marker_area is None or self.has_marker(card["img"]):
+            idx = card.get("idx", idx)
+            group = card.get("group")
+            results = self.get_shared_results(group)
+            shared = self.get_scan_results(group)
+            state = self.get_journal_state(idx)
+
+            if state.get("saved") or state.get("quarantined"):
+                LOGGER.debug("Card #%s is already processed, skipping" % (idx + 1))
+                continue
+
+            if "matched" not in shared:
+                # Для копий карты (см. `boardtt.fingerprint`) распознавание
+                # производится только один раз. В других сканах изображения
+                # регионов берутся с копии, распознанные тексты - общие.
+                known = results if "matched" in results else state
+                if "matched" in known:  # Распознана ранее или в прерванном запуске.
+                    shared["matched"] = known["matched"]
+                    if shared["matched"]:
+                        shared["areas"] = self.get_areas(card["img"], known["areas"])
+
+                elif self.run_journaled(
+                    idx, "ocr", lambda: self.recognize_card(card["img"], shared)
+                ):
+                    self.record_journal(
+                        idx,
+                        "ocr",
+                        matched=shared["matched"],
+                        areas=self.get_recognized_texts(shared),
+                    )
+
+                else:
+                    continue
+
+                if group is not None and "matched" not in results:
+                    results["matched"] = shared["matched"]
+                    results["areas"] = self.get_recognized_texts(shared)
+
+            if shared["matched"]:
                 self.cards[idx] = {
                     "img": card["img"],
                     "coords": card["coords"],
-                    "areas": self.get_areas(card["img"]),
+                    "group": group,
+                    "areas": {
+                        name: dict(area_data)
+                        for name, area_data in shared["areas"].items()
+                    },
                 }
 
+        LOGGER.debug(
+            "OCR: %s areas recognized, %s of them retried (%s retries total)"
+            % (self.ocr_areas, self.ocr_retried_areas, self.ocr_retries)
+        )
+
+    def recognize_card(self, card, shared):
+        """Определяет, относится ли карта к данному типу, и распознаёт её регионы.
+        Результат помещается в `shared`.
+
+        :param card: Изображение карты
+        :param dict shared: Словарь результатов обработки
+        :return:
+        """
+        matched = self.marker_area is None or self.has_marker(card)
+        areas = self.get_areas(card) if matched else None
+
+        shared["matched"] = matched
+        shared["areas"] = areas
+
+    @staticmethod
+    def get_recognized_texts(shared):
+        """Возвращает распознанные тексты регионов карты
+        (`{имя: {"str": ..., "confidence": ...}}`) или None,
+        если карта не относится к типу.
+
+        :param dict shared: Словарь результатов обработки (см. `recognize_card()`)
+        :return:
+        """
+        if not shared["matched"]:
+            return None
+        return {
+            name: {"str": data["str"], "confidence": data["confidence"]}
+            for name, data in shared["areas"].items()
+        }
+
+    def get_journal_state(self, idx):
+        """Возвращает записанное в журнал состояние обработки карты.
+
+        :param int idx: Индекс (номер в последовательности) карты
+        :return:
+        """
+        if self.journal is None:
+            return {}
+        return self.journal.get_card_state(type(self).__name__, idx)
+
+    def run_journaled(self, idx, stage, func):
+        """Выполняет этап обработки карты. При наличии журнала ошибки
+        записываются в него, этап повторяется, а карта, этап для которой
+        так и не удался, помещается в карантин.
+        Возвращает булево, указывающее на то, что этап выполнен.
+
+        :param int idx: Индекс (номер в последовательности) карты
+        :param str stage: Название этапа
+        :param func: Функция, выполняющая этап
+        :return:
+        """
+        if self.journal is None:
+            func()
+            return True
+
+        return self.journal.run_card_stage(type(self).__name__, idx, stage, func)
+
+    def record_journal(self, idx, event, **data):
+        """Записывает в журнал (если он есть) событие обработки карты.
+
+        :param int idx: Индекс (номер в последовательности) карты
+        :param str event: Событие
+        :return:
+        """
+        if self.journal is not None:
+            self.journal.record_card(type(self).__name__, idx, event, **data)
+
+    def get_shared_results(self, group):
+        """Возвращает словарь результатов обработки, общий для всех копий карты
+        данного типа во всех сканах проекта. Если карта не отнесена к группе копий,
+        словарь новый.
+
+        Словарь живёт всё время обработки проекта, поэтому в нём хранятся
+        только распознанные тексты и имя файла перевода, но не изображения.
+
+        :param CardGroup|None group: Группа копий карты
+        :return:
+        """
+        if group is None:
+            return {}
+        return group.results.setdefault(type(self), {})
+
+    def get_scan_results(self, group):
+        """Возвращает словарь результатов обработки, общий для копий карты
+        данного типа в пределах скана: данные регионов с изображениями
+        и локализованное изображение. Освобождается вместе с обработчиком скана.
+        Если карта не отнесена к группе копий, словарь новый.
+
+        :param CardGroup|None group: Группа копий карты
+        :return:
+        """
+        if group is None:
+            return {}
+        return self.scan_results.setdefault(group.id, {})
+
     def get_file_dir(self, card_id, fname):
         """Возвращает директорию, содержащую материалы для локализации
         для указанной карты.
@@ -148,41 +335,122 @@ class CardType:
     def save_files(self):
         """Сохраняет файлы проекта локализации."""
         for idx, card in self.cards.items():
-            card_id = self.get_card_id(idx, card)
+            if self.run_journaled(idx, "save", lambda: self.save_card_files(idx, card)):
+                self.record_journal(idx, "saved")
+
+    @staticmethod
+    def get_translation_fname(json_fname):
+        """Возвращает путь к файлу, из которого берётся перевод карты:
+        для копии - файл, на который ссылается её `duplicate_of`, иначе - сам файл.
 
-            LOGGER.info("Saving %s card files ..." % card_id)
+        :param str json_fname: Путь к файлу с данными карты
+        :return:
+        """
+        visited = set()
+        while json_fname not in visited:
+            visited.add(json_fname)
+            with open(json_fname) as f:
+                duplicate_of = json.load(f).get("duplicate_of")
 
-            json_fname = self.get_file_dir(card_id, "card.json")
+            if duplicate_of is None:
+                break
 
-            if os.path.exists(json_fname):
-                LOGGER.debug("Translation file already exists.")
-                LOGGER.info(
-                    "Card image files will be changed using data from %s." % json_fname
+            source = os.path.normpath(
+                os.path.join(os.path.dirname(json_fname), duplicate_of)
+            )
+            if not os.path.exists(source):
+                LOGGER.warning(
+                    "%s refers to missing %s, its own text is used"
+                    % (json_fname, source)
                 )
+                break
+            json_fname = source
+
+        return json_fname
+
+    def save_card_files(self, idx, card):
+        """Сохраняет файлы проекта локализации для карты.
+
+        :param int idx: Индекс (номер в последовательности) карты
+        :param dict card: Словарь с данными карты
+        :return:
+        """
+        card_id = self.get_card_id(idx, card)
+
+        LOGGER.info("Saving %s card files ..." % card_id)
+
+        json_fname = self.get_file_dir(card_id, "card.json")
+
+        # Перевод копий карты берётся из файла первой встреченной копии.
+        # Для уже сохранённой карты он указан в её файле (`duplicate_of`),
+        # для новой - определяется по порядку обработки карт.
+        shared = self.get_shared_results(card["group"])
+
+        translation_fname = None
+        if os.path.exists(json_fname):
+            translation_fname = self.get_translation_fname(json_fname)
+            if card["group"] is not None:
+                shared.setdefault("json_fname", translation_fname)
+            source_json_fname = translation_fname
+        else:
+            source_json_fname = shared.setdefault("json_fname", json_fname)
+            if source_json_fname != json_fname and os.path.exists(source_json_fname):
+                translation_fname = source_json_fname
+
+        is_copy = source_json_fname != json_fname
+
+        if translation_fname is not None:
+            LOGGER.debug("Translation file already exists.")
+            LOGGER.info(
+                "Card image files will be changed using data from %s."
+                % translation_fname
+            )
+
+            with open(translation_fname) as f:
+                json_data = json.load(f)
+
+            for area_name, area_data in json_data["areas"].items():
+                card["areas"][area_name]["str"] = area_data["str"]
 
-                with open(json_fname) as f:
-                    json_data = json.load(f)
+        if not os.path.exists(json_fname):  # do not overwrite existing files
+            save_image(card["img"], self.get_file_dir(card_id, "card.png"))
 
-                for area_name, area_data in json_data["areas"].items():
-                    card["areas"][area_name]["str"] = area_data["str"]
+            json_data = {"coords": card["coords"], "areas": {}}
+            if is_copy:
+                json_data["duplicate_of"] = os.path.relpath(
+                    source_json_fname, os.path.dirname(json_fname)
+                )
+            for area_name, area_data in card["areas"].items():
+                json_data["areas"][area_name] = {"str": area_data["str"]}
+
+            LOGGER.info("Generating card translation file %s ..." % json_fname)
 
-            else:  # do not overwrite existing files
-                card["img"].save(self.get_file_dir(card_id, "card.png"))
+            with atomic_write(json_fname) as f:
+                json.dump(json_data, f, indent=4)
 
-                json_data = {"coords": card["coords"], "areas": {}}
-                for area_name, area_data in card["areas"].items():
-                    json_data["areas"][area_name] = {"str": area_data["str"]}
+        if "svg" in self.overlay_formats:
+            LOGGER.info("Generating vector overlay for %s ..." % card_id)
+            with atomic_write(self.get_file_dir(card_id, "card_tr.svg")) as f:
+                f.write(get_card_svg(self, card, self.config.image_dpi))
 
-                LOGGER.info("Generating card translation file %s ..." % json_fname)
+        if "png" not in self.overlay_formats:
+            return
 
-                with open(json_fname, "w") as f:
-                    json.dump(json_data, f, indent=4)
+        texts = tuple(area_data["str"] for area_data in card["areas"].values())
+        scan_shared = self.get_scan_results(card["group"])
+        cached_texts, img_tr = scan_shared.get("tr_img", (None, None))
 
+        if cached_texts == texts:
+            LOGGER.debug("Reusing localized image of a card copy for %s" % card_id)
+        else:
             img_tr = self.get_tr_image(card, idx)
-            img_comp = self.get_composite_image(card["img"], img_tr, card_id)
+            if card["group"] is not None:
+                scan_shared["tr_img"] = (texts, img_tr)
 
-            img_tr.save(self.get_file_dir(card_id, "card_tr.png"))
-            img_comp.save(self.get_file_dir(card_id, "card_comp.png"))
+        img_comp = self.get_composite_image(card["img"], img_tr, card_id)
+
+        save_image(img_tr, self.get_file_dir(card_id, "card_tr.png"))
+        save_image(img_comp, self.get_file_dir(card_id, "card_comp.png"))
 
     @classmethod
     def normalize_numeric(cls, val):
@@ -202,7 +470,9 @@ class CardType:
         :param card:
         :return:
         """
-        found_value, img, _ = self.recognize_area(card, getattr(self, self.marker_area))
+        found_value, img, _, _ = self.recognize_area(
+            card, getattr(self, self.marker_area)
+        )
         if self.DEBUG:
             img.show()
             LOGGER.info(
@@ -232,6 +502,71 @@ class CardType:
 
         return img
 
+    @classmethod
+    def enhance_img_otsu(cls, img):
+        """Производит подготовку изображения к распознаванию, вычисляя порог
+        бинаризации по гистограмме изображения (метод Оцу).
+        Помогает для тёмных и засвеченных карт.
+
+        :param img:
+        :return:
+        """
+        img = ImageOps.autocontrast(img.convert("L"))
+        histogram = img.histogram()
+
+        total = sum(histogram)
+        sum_total = sum(idx * count for idx, count in enumerate(histogram))
+
+        threshold = 0
+        best_variance = 0.0
+        sum_bg = 0
+        weight_bg = 0
+
+        for idx, count in enumerate(histogram):
+            weight_bg += count
+            if not weight_bg:
+                continue
+            weight_fg = total - weight_bg
+            if not weight_fg:
+                break
+
+            sum_bg += idx * count
+            mean_bg = sum_bg / weight_bg
+            mean_fg = (sum_total - sum_bg) / weight_fg
+
+            variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+            if variance > best_variance:
+                best_variance = variance
+                threshold = idx
+
+        img = img.point(lambda p: p > threshold and 255)
+
+        histogram = img.histogram()
+        if histogram[0] > histogram[255]:  # Светлый текст на тёмной подложке.
+            img = ImageOps.invert(img)
+
+        return ImageOps.expand(img, border=60, fill=255)
+
+    @classmethod
+    def enhance_img_adaptive(cls, img, radius=15, offset=10):
+        """Производит подготовку изображения к распознаванию, сравнивая каждый пиксел
+        со средней яркостью его окрестности (адаптивный порог).
+        Помогает для глянцевых карт и неравномерно освещённых сканов.
+
+        :param img:
+        :param int radius: Радиус окрестности, в пикселах
+        :param int offset: На сколько пиксел должен быть темнее окрестности, чтобы считаться текстом
+        :return:
+        """
+        img = img.convert("L")
+        local_mean = img.filter(ImageFilter.BoxBlur(radius))
+
+        # Насколько пиксел темнее окрестности (отрицательные значения обрезаются до 0).
+        darker_by = ImageChops.subtract(local_mean, img)
+        img = darker_by.point(lambda p: p <= offset and 255)
+
+        return ImageOps.expand(img, border=60, fill=255)
+
     @classmethod
     def get_bg_img(cls, img, box_size=6, bg_start=3):
         """Возвращает образец с подложки (фона) региона.
@@ -265,7 +600,7 @@ class CardType:
         """
         dr = ImageDraw.Draw(img)
 
-        line_height = font.getbbox("jN")[1] * 1.25
+        line_height = self.get_line_height(font)
 
         for line in text.splitlines():
             dr.text((x, y), line, color, font=font)
@@ -273,6 +608,15 @@ class CardType:
 
         return img
 
+    @classmethod
+    def get_line_height(cls, font):
+        """Возвращает шаг строк текста для указанного шрифта.
+
+        :param font:
+        :return:
+        """
+        return font.getbbox("jN")[1] * 1.25
+
     @classmethod
     def get_font(cls, font_size=40, font_name=None):
         """Возвращает шрифт указанноти типа и размера.
@@ -302,11 +646,25 @@ class CardType:
         if "/" not in font_name:
             font_name = f"/usr/share/fonts/truetype/ubuntu/{font_name}"
 
-        return ImageFont.truetype(font_name, font_size)
+        fonts = getattr(_FONTS_CACHE, "fonts", None)
+        if fonts is None:
+            fonts = _FONTS_CACHE.fonts = {}
+
+        key = (font_name, font_size)
+        font = fonts.get(key)
+        if font is None:
+            font = fonts[key] = ImageFont.truetype(font_name, font_size)
+
+        return font
 
     def recognize_area(self, card, area):
         """Производит попытку распознать регион.
-        Возвращает кортеж: (распознанный_текст, изображение_региона_для_распознания, оригинальное_изображение_региона)
+        Возвращает кортеж: (распознанный_текст, изображение_региона_для_распознания,
+        оригинальное_изображение_региона, уверенность_распознавания)
+
+        Если уверенность распознавания ниже `min_confidence`, регион распознаётся
+        повторно (не более `max_ocr_retries` раз) с подготовкой из `enhance_fallbacks`,
+        и берётся наиболее уверенный результат.
 
         :param card:
         :param area:
@@ -314,15 +672,36 @@ class CardType:
         """
         marker_coords = area.get_coords(self.config)
         img_orig = card.crop(marker_coords)
-        img = self.enhance_img(img_orig)
 
-        if area.rotate is not None:
-            img = img.rotate(area.rotate)
+        def recognize(enhance):
+            img = enhance(img_orig)
+            if area.rotate is not None:
+                img = img.rotate(area.rotate)
+            return TesseractAPI.recognize_words(img), img
+
+        result, img = recognize(self.enhance_img)
+        self.ocr_areas += 1
+
+        fallbacks = self.enhance_fallbacks[: self.max_ocr_retries]
+        if fallbacks and result.confidence < self.min_confidence:
+            self.ocr_retried_areas += 1
 
-        text = TesseractAPI.recognize(img).strip()
+            for fallback in fallbacks:
+                self.ocr_retries += 1
+                LOGGER.debug(
+                    "Low OCR confidence (%.1f), retrying with `%s` ..."
+                    % (result.confidence, fallback)
+                )
+                retry_result, retry_img = recognize(getattr(self, fallback))
+                if retry_result.confidence > result.confidence:
+                    result, img = retry_result, retry_img
+                if result.confidence >= self.min_confidence:
+                    break
+
+        text = result.text.strip()
         text = re.sub(RE_SPACES, r"\g<0>", text)  # strip consecutive whitespaces
 
-        return text, img, img_orig
+        return text, img, img_orig, result.confidence
 
     def adjust_text_to_box(self, text, height, width):
         """Вписывает текст в пределы, подбирая его размер.
@@ -367,32 +746,55 @@ class CardType:
 
         return font, text_x, text_y
 
-    def get_areas(self, card):
+    def get_areas(self, card, recognized=None):
         """Возвращает словарь с данными регионов карты.
 
         :param card:
+        :param dict|None recognized: Уже распознанные тексты регионов
+            (`{имя: {"str": ..., "confidence": ...}}`). Если переданы,
+            регионы не распознаются.
         :return:
         """
         areas = {}
-        for name, val in self.__dict__.items():
-            if isinstance(val, CardArea):
-                text, img, img_orig = self.recognize_area(card, val)
+        for name, val in self.get_area_definitions().items():
+            if recognized is not None and name in recognized:
+                img_orig = img = card.crop(val.get_coords(self.config))
+                text = recognized[name]["str"]
+                confidence = recognized[name]["confidence"]
+
+            else:
+                text, img, img_orig, confidence = self.recognize_area(card, val)
 
                 if name in self.norm_numeric:
                     text = self.normalize_numeric(text)
 
-                img_bg = None
+            img_bg = None
+
+            if val.render:
+                img_bg = self.get_bg_img(img_orig, box_size=val.bg_box_size)
+
+            areas[name] = {
+                "str": text,
+                "confidence": confidence,
+                "coords": val.get_coords(self.config),
+                "img_bg": img_bg,
+                "img_orig": img_orig,
+                "img": img,
+                "render": val.render,
+                "rotate": val.rotate,
+            }
+        return areas
 
-                if val.render:
-                    img_bg = self.get_bg_img(img_orig, box_size=val.bg_box_size)
+    @classmethod
+    def get_area_definitions(cls):
+        """Возвращает словарь с описаниями регионов (`CardArea`), объявленных
+        в классе типа карты и его предках, в порядке объявления.
 
-                areas[name] = {
-                    "str": text,
-                    "coords": val.get_coords(self.config),
-                    "img_bg": img_bg,
-                    "img_orig": img_orig,
-                    "img": img,
-                    "render": val.render,
-                    "rotate": val.rotate,
-                }
-        return areas
+        :return:
+        """
+        definitions = {}
+        for klass in reversed(cls.__mro__):
+            for name, val in vars(klass).items():
+                if isinstance(val, CardArea):
+                    definitions[name] = val
+        return definitions
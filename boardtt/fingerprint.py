@@ -0,0 +1,240 @@
+from PIL import Image, ImageChops, ImageFilter, ImageStat
+
+from boardtt.logger import LOGGER
+from boardtt.marker import CardsData
+
+
+def dhash(img: Image.Image, hash_size: int = 8) -> int:
+    """Возвращает перцептивный (разностный) хеш изображения.
+
+    Изображение уменьшается до `hash_size + 1` x `hash_size` в оттенках серого,
+    каждый бит хеша - светлее ли пиксел своего соседа справа.
+    """
+    small = img.convert("L").resize(
+        (hash_size + 1, hash_size), Image.Resampling.LANCZOS
+    )
+    pixels = small.tobytes()
+
+    value = 0
+    for y in range(hash_size):
+        row = y * (hash_size + 1)
+        for x in range(hash_size):
+            value = (value << 1) | (pixels[row + x] > pixels[row + x + 1])
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Возвращает количество различающихся бит двух хешей."""
+    return (a ^ b).bit_count()
+
+
+class CardGroup:
+    """Группа почти одинаковых карт (копий одной карты).
+
+    Результаты обработки, вычисленные для первой карты группы, хранятся
+    в `results` по типу карты и переиспользуются для остальных копий.
+    Группы живут всё время обработки проекта, поэтому изображения в `results`
+    не хранятся (см. `CardType.get_shared_results`).
+    """
+
+    def __init__(
+        self,
+        group_id: int,
+        fingerprint: int,
+        thumb: Image.Image,
+        detail: Image.Image | None = None,
+    ):
+        self.id = group_id
+        self.fingerprint = fingerprint
+        self.thumb = thumb
+        self.detail = detail
+        self.size = 0
+        self.results = {}
+
+
+class CardDeduplicator:
+    """Находит копии одной и той же карты в пределах скана и между сканами проекта.
+
+    Кандидаты в копии отбираются по расстоянию Хэмминга между перцептивными хешами
+    и поблочным сравнением сильно уменьшенных изображений, затем сходство
+    проверяется на изображениях в половину разрешения скана (см. `is_same_detail()`):
+    так карты, различающиеся одной цифрой в тексте, не считаются копиями.
+
+    Чтобы находить копии между сканами, один экземпляр передаётся
+    во все `ImageProcessingManager` проекта. Для каждой группы хранится
+    изображение в половину разрешения в оттенках серого (около 200 КБ
+    для карты 63x88 мм при 300 dpi).
+
+    :param max_distance: Максимальное расстояние Хэмминга между хешами копий
+    :param max_block_diff: Максимальная средняя разница яркости (0-255) в блоке
+        уменьшенных изображений копий (предварительный отбор)
+    :param max_detail_diff: Максимальная средняя разница яркости (0-255) в ячейке
+        `detail_cell` x `detail_cell` изображений копий при точной проверке.
+        Копии обычно укладываются в 10, карты, отличающиеся одним символом
+        текста, дают от 30.
+    :param max_shift: Наибольший сдвиг копий друг относительно друга, в пикселах скана
+        (карты на сканах лежат не идеально одинаково)
+    """
+
+    thumb_size = (96, 128)
+    blocks = (12, 16)
+
+    # Во сколько раз уменьшаются изображения для точной проверки.
+    detail_factor = 2
+    # Радиус размытия изображений точной проверки, подавляющего шум сканера.
+    detail_blur = 0.7
+    # Размер ячейки точной проверки, в пикселах уменьшенного изображения.
+    detail_cell = 3
+
+    def __init__(
+        self,
+        max_distance: int = 10,
+        max_block_diff: int = 40,
+        max_detail_diff: int = 20,
+        max_shift: int = 16,
+    ):
+        self.max_distance = max_distance
+        self.max_block_diff = max_block_diff
+        self.max_detail_diff = max_detail_diff
+        self.max_shift = max_shift
+        self.groups: list[CardGroup] = []
+
+    def _make_thumb(self, img: Image.Image) -> Image.Image:
+        return img.convert("L").resize(self.thumb_size, Image.Resampling.BOX)
+
+    def _make_detail(self, img: Image.Image) -> Image.Image:
+        size = (img.width // self.detail_factor, img.height // self.detail_factor)
+        detail = img.convert("L").resize(size, Image.Resampling.BOX)
+        return detail.filter(ImageFilter.GaussianBlur(self.detail_blur))
+
+    def is_same(self, thumb_a: Image.Image, thumb_b: Image.Image) -> bool:
+        """Проверяет, что уменьшенные изображения не различаются ни в одном блоке."""
+        diff = ImageChops.difference(thumb_a, thumb_b)
+        block_diffs = diff.resize(self.blocks, Image.Resampling.BOX)
+        return max(block_diffs.getdata()) <= self.max_block_diff
+
+    def is_same_detail(self, detail_a: Image.Image, detail_b: Image.Image) -> bool:
+        """Проверяет, что изображения в половину разрешения не различаются
+        ни в одной ячейке `detail_cell` x `detail_cell`.
+
+        Изображения сначала совмещаются (см. `_align()`), затем пиксел считается
+        отличающимся, только если он выходит за пределы яркости соседних пикселов
+        другого изображения: так не учитываются остаточная неточность совмещения
+        и шум сканера на границах линий.
+        """
+        if detail_a.size != detail_b.size:
+            return False
+
+        margin = self.max_shift // self.detail_factor
+        dx, dy = self._align(detail_a, detail_b, margin)
+        base, moved = self._crop_shifted(detail_a, detail_b, margin, dx, dy)
+
+        diff = ImageChops.lighter(
+            self._get_envelope_diff(base, moved), self._get_envelope_diff(moved, base)
+        )
+        cells = diff.resize(
+            (
+                max(diff.width // self.detail_cell, 1),
+                max(diff.height // self.detail_cell, 1),
+            ),
+            Image.Resampling.BOX,
+        )
+        return max(cells.getdata()) <= self.max_detail_diff
+
+    @staticmethod
+    def _crop_shifted(
+        img: Image.Image, other: Image.Image, margin: int, dx: int, dy: int
+    ) -> tuple[Image.Image, Image.Image]:
+        """Возвращает совпадающие по размеру области изображений: `img` без полей
+        шириной `margin` и `other`, сдвинутое на (`dx`, `dy`)."""
+        width, height = img.size
+        box = (margin, margin, width - margin, height - margin)
+        moved_box = (box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy)
+        return img.crop(box), other.crop(moved_box)
+
+    def _get_mean_diff(
+        self, img: Image.Image, other: Image.Image, margin: int, dx: int, dy: int
+    ) -> float:
+        base, moved = self._crop_shifted(img, other, margin, dx, dy)
+        return ImageStat.Stat(ImageChops.difference(base, moved)).mean[0]
+
+    def _align(
+        self, img: Image.Image, other: Image.Image, margin: int
+    ) -> tuple[int, int]:
+        """Возвращает сдвиг (не больше `margin`), при котором изображения
+        совпадают лучше всего. Сдвиг сначала подбирается на изображениях,
+        уменьшенных вдвое, затем уточняется."""
+        small_img, small_other = (
+            i.resize((i.width // 2, i.height // 2), Image.Resampling.BOX)
+            for i in (img, other)
+        )
+        small_margin = margin // 2
+        shifts = range(-small_margin, small_margin + 1)
+        dx, dy = min(
+            ((dx, dy) for dy in shifts for dx in shifts),
+            key=lambda shift: self._get_mean_diff(
+                small_img, small_other, small_margin, *shift
+            ),
+        )
+
+        candidates = [
+            (dx * 2 + ddx, dy * 2 + ddy)
+            for ddy in (-1, 0, 1)
+            for ddx in (-1, 0, 1)
+            if abs(dx * 2 + ddx) <= margin and abs(dy * 2 + ddy) <= margin
+        ]
+        return min(
+            candidates,
+            key=lambda shift: self._get_mean_diff(img, other, margin, *shift),
+        )
+
+    @staticmethod
+    def _get_envelope_diff(img: Image.Image, other: Image.Image) -> Image.Image:
+        """Возвращает, насколько пикселы `other` выходят за пределы яркости
+        пикселов `img` в окрестности 3x3."""
+        return ImageChops.lighter(
+            ImageChops.subtract(other, img.filter(ImageFilter.MaxFilter(3))),
+            ImageChops.subtract(img.filter(ImageFilter.MinFilter(3)), other),
+        )
+
+    def get_group(self, img: Image.Image) -> CardGroup:
+        """Возвращает группу карты, создавая новую, если копий ещё не встречалось."""
+        fingerprint = dhash(img)
+        thumb = self._make_thumb(img)
+        detail = None
+
+        candidates = sorted(
+            (hamming_distance(fingerprint, group.fingerprint), group.id)
+            for group in self.groups
+        )
+        for distance, group_id in candidates:
+            if distance > self.max_distance:
+                break
+            group = self.groups[group_id]
+            if not self.is_same(thumb, group.thumb):
+                continue
+
+            if detail is None:
+                detail = self._make_detail(img)
+            if self.is_same_detail(detail, group.detail):
+                group.size += 1
+                return group
+
+        if detail is None:
+            detail = self._make_detail(img)
+        group = CardGroup(len(self.groups), fingerprint, thumb, detail)
+        group.size = 1
+        self.groups.append(group)
+        return group
+
+    def assign_groups(self, cards: CardsData) -> None:
+        """Проставляет картам группы копий (ключ `group`)."""
+        groups_before = len(self.groups)
+
+        for card in cards:
+            card["group"] = self.get_group(card["img"])
+
+        LOGGER.info(
+            "%s cards fingerprinted, %s new distinct card(s), %s known in total"
+            % (len(cards), len(self.groups) - groups_before, len(self.groups))
+        )
@@ -0,0 +1,181 @@
+import json
+import os
+import time
+from typing import Callable
+
+from boardtt.logger import LOGGER
+
+
+class ProgressJournal:
+    """Журнал хода пакетной обработки проекта (директории со сканами).
+
+    Журнал - файл JSON-строк, каждая запись дописывается в конец и сбрасывается
+    на диск до того, как обработка пойдёт дальше. По журналу прерванный запуск
+    можно продолжить с того места, где он остановился (см. `boardtt.batch`):
+    обработанные сканы и карты пропускаются, уже распознанные карты
+    не распознаются повторно.
+
+    Элементы (сканы и карты), обработка которых не удалась `max_attempts` раз,
+    помещаются в карантин и далее пропускаются.
+
+    :param project_dir: Директория проекта
+    :param max_attempts: Сколько попыток обработки даётся скану или карте
+    :param reset: Начать журнал заново, забыв о предыдущих запусках
+    """
+
+    filename = ".boardtt-journal.jsonl"
+
+    def __init__(
+        self, project_dir: str | os.PathLike, max_attempts: int = 3, reset: bool = False
+    ):
+        self.path = os.path.join(project_dir, self.filename)
+        self.max_attempts = max_attempts
+        self.scans = {}
+        self.cards = {}
+
+        if reset and os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # Запись, оборванная падением процесса.
+                    continue
+                self._apply(record)
+
+        LOGGER.info("Progress journal loaded from %s" % self.path)
+
+    def _apply(self, record: dict) -> dict:
+        """Учитывает запись в состоянии журнала. Возвращает состояние элемента."""
+        event = record["event"]
+
+        if "card" in record:
+            state = self.get_card_state(
+                record["scan"], record["card_type"], record["card"]
+            )
+            if event == "ocr":
+                state["matched"] = record["matched"]
+                state["areas"] = record.get("areas")
+            elif event == "saved":
+                state["saved"] = True
+        else:
+            state = self.get_scan_state(record["scan"])
+            if event == "start":
+                state["starts"] += 1
+            elif event == "done":
+                state["done"] = True
+
+        if event == "failed":
+            state["failures"] += 1
+        elif event == "quarantined":
+            state["quarantined"] = True
+
+        return state
+
+    def get_scan_state(self, scan: str) -> dict:
+        """Возвращает состояние обработки скана."""
+        return self.scans.setdefault(
+            scan, {"starts": 0, "failures": 0, "done": False, "quarantined": False}
+        )
+
+    def get_card_state(self, scan: str, card_type: str, idx: int) -> dict:
+        """Возвращает состояние обработки карты скана данным типом карт."""
+        return self.cards.setdefault(
+            (scan, card_type, idx),
+            {"failures": 0, "saved": False, "quarantined": False},
+        )
+
+    def record(self, **record) -> dict:
+        """Дописывает запись в журнал. Возвращает обновлённое состояние элемента."""
+        record["at"] = time.time()
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+
+        # Одна запись - одна операция записи в файл, открытый на дозапись,
+        # поэтому записи нескольких процессов не перемешиваются.
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        return self._apply(record)
+
+    def scan(self, scan: str) -> "ScanJournal":
+        """Возвращает журнал для указанного скана."""
+        return ScanJournal(self, scan)
+
+    def get_quarantined(self) -> list[str]:
+        """Возвращает описание элементов, помещённых в карантин."""
+        items = [scan for scan, state in self.scans.items() if state["quarantined"]]
+        items.extend(
+            f"{scan}: {card_type} #{idx + 1}"
+            for (scan, card_type, idx), state in self.cards.items()
+            if state["quarantined"]
+        )
+        return items
+
+
+class ScanJournal:
+    """Часть журнала, относящаяся к одному скану."""
+
+    def __init__(self, journal: ProgressJournal, scan: str):
+        self.journal = journal
+        self.scan = scan
+
+    @property
+    def state(self) -> dict:
+        return self.journal.get_scan_state(self.scan)
+
+    def record(self, event: str, **data) -> dict:
+        """Записывает событие обработки скана."""
+        return self.journal.record(scan=self.scan, event=event, **data)
+
+    def get_card_state(self, card_type: str, idx: int) -> dict:
+        return self.journal.get_card_state(self.scan, card_type, idx)
+
+    def record_card(self, card_type: str, idx: int, event: str, **data) -> dict:
+        """Записывает событие обработки карты."""
+        return self.journal.record(
+            scan=self.scan, card_type=card_type, card=idx, event=event, **data
+        )
+
+    def run_card_stage(
+        self, card_type: str, idx: int, stage: str, func: Callable[[], None]
+    ) -> bool:
+        """Выполняет этап обработки карты, повторяя его при ошибках.
+
+        Возвращает булево, указывающее на то, что этап выполнен. Если этап
+        не удался `max_attempts` раз (с учётом прошлых запусков), карта
+        помещается в карантин.
+        """
+        while True:
+            try:
+                func()
+
+            except Exception as e:
+                LOGGER.exception(
+                    "Stage `%s` failed for %s card #%s of %s"
+                    % (stage, card_type, idx + 1, self.scan)
+                )
+                state = self.record_card(
+                    card_type, idx, "failed", stage=stage, error=str(e) or repr(e)
+                )
+
+                if state["failures"] >= self.journal.max_attempts:
+                    LOGGER.error(
+                        "%s card #%s of %s quarantined"
+                        % (card_type, idx + 1, self.scan)
+                    )
+                    self.record_card(card_type, idx, "quarantined", stage=stage)
+                    return False
+
+            else:
+                return True
@@ -1,77 +1,186 @@
+import glob
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from typing import Type, Iterable
 
+from boardtt.calibration import CalibrationSession
 from boardtt.card_type import CardType
 from boardtt.config import Config
+from boardtt.fingerprint import CardDeduplicator, CardGroup
+from boardtt.journal import ScanJournal
 from boardtt.logger import LOGGER
-from boardtt.marker import PlanarCardMarker, CardMarker
+from boardtt.marker import PlanarCardMarker, CardMarker, CardsData
+from boardtt.shared_scan import ScanBufferSpec, SharedScanBuffer, SharedScanCardMarker
+from boardtt.sources import ScanPage
+from boardtt.utils import atomic_write
+from boardtt.vector import get_sheet_svg
+
+
+def _process_cards_chunk(
+    config: Config,
+    card_type: Type[CardType],
+    target_dir: str,
+    spec: ScanBufferSpec,
+    cards: list[tuple[int, tuple[int, int, int, int]]],
+    journal: ScanJournal | None = None,
+) -> None:
+    """Обрабатывает часть карт скана в дочернем процессе.
+    Изображения карт берутся из разделяемой памяти скана без копирования.
+
+    :param cards: Список кортежей (номер карты на скане, координаты карты)
+    """
+    buffer = SharedScanBuffer.attach(spec)
+    try:
+        # Карты части - копии одной карты (если известно), распознаём один раз.
+        group = CardGroup(0, 0, None) if len(cards) > 1 else None
+        chunk = [
+            {"img": buffer.view(coords), "coords": coords, "idx": idx, "group": group}
+            for idx, coords in cards
+        ]
+        card_type(config, chunk, target_dir, journal).save_files()
+        del chunk
+    finally:
+        buffer.close()
 
 
 class ImageProcessingManager:
     def __init__(
         self,
         config: Config,
-        image_path: str | os.PathLike,
+        image_path: str | os.PathLike | ScanPage,
         card_types: Iterable[Type[CardType]],
+        dedup: CardDeduplicator | None = None,
+        workers: int = 1,
+        journal: ScanJournal | None = None,
     ):
+        """
+        :param config: Конфигурация скана
+        :param image_path: Путь к скану или страница многостраничного скана
+            (см. `boardtt.sources.iter_scan_pages`)
+        :param card_types: Типы карт
+        :param dedup: Поиск копий карт, общий для сканов проекта
+        :param workers: Количество процессов, обрабатывающих карты скана.
+            При `workers` > 1 скан размещается в разделяемой памяти, копии карт
+            распознаются один раз только в пределах скана.
+        :param journal: Журнал хода обработки скана, позволяющий продолжить
+            прерванную обработку (см. `boardtt.batch`)
+        """
         self.config = config
         self.image_path = image_path
         self.card_types = card_types
-        self.card_marker: CardMarker = PlanarCardMarker(config, image_path)
+        self.dedup = dedup
+        self.workers = workers
+        self.journal = journal
+        if workers > 1:
+            self.card_marker: CardMarker = SharedScanCardMarker(config, image_path)
+        else:
+            self.card_marker: CardMarker = PlanarCardMarker(config, image_path)
 
-    def debug_process_card_type(
-        self,
-        card_type: Type[CardType],
-        debug: bool = False,
-        target_area: str = "text",
-        show_composite: bool = False,
-    ) -> None:
-        """TODO: Remove this for something better
-        Вспомогательная функция, используется при объявлении типов карт (создании классов),
-        для нахождения координат регионов.
+    def calibrate(
+        self, card_type: Type[CardType], thumb_width: int = 240
+    ) -> CalibrationSession:
+        """Возвращает сессию подбора координат регионов указанного типа карт.
+        Используется при объявлении типов карт (создании классов).
+
+        Пример::
+
+            manager.calibrate(StarWarsLureEnhance).run("calibration.png")
 
         :param card_type: Класс типа карты
-        :param debug: Флаг указывающий не необходимость вывода дополнительной отладочной информации.
-        :param target_area: Имя отладиваемого региона
-        :param show_composite: Флаг, указывающий на то следует ли показывать локализованную версию карты.
+        :param thumb_width: Ширина карты на листе предпросмотра, в пикселах
         """
-        card_type.DEBUG = debug
-
-        # THIS IS NOT WORKING ANYWAY
-        # cards = self.card_marker.get_cards()
-        # if debug:
-        #     for card in cards:
-        #         card["img"].show()
-        #
-        # matches = card_type(cards)
-        #
-        # LOGGER.warning("** Card indexes: %s" % matches.cards.keys())
-        #
-        # for idx, card in matches.cards.items():
-        #     if not show_composite:
-        #         LOGGER.warning(
-        #             "** Text in `%s` area: %s"
-        #             % (target_area, card["areas"][target_area]["str"])
-        #         )
-        #         card["areas"][target_area]["img"].show()
-        #     else:
-        #         card_id = card_type.get_card_id(idx, card)
-        #         img_tr = card_type.get_tr_image(card, idx)
-        #         img_comp = card_type.get_composite_image(card["img"], img_tr, card_id)
-        #         img_comp.show()
+        return CalibrationSession(
+            self.config, self.card_marker.get_cards(), card_type, thumb_width
+        )
 
     def process(self):
         """Производит обработку указанного скана, используя
         указанные типы карт"""
         LOGGER.info("Image processing started")
 
-        target_dir = os.path.splitext(self.image_path)[0]
+        if isinstance(self.image_path, ScanPage):
+            target_dir = self.image_path.target_dir
+        else:
+            target_dir = os.path.splitext(self.image_path)[0]
         LOGGER.debug("Target path: %s" % target_dir)
         cards = self.card_marker.get_cards()
 
-        for card_type in self.card_types:
-            LOGGER.info("Processing using %s ..." % card_type.__name__)
-            card = card_type(self.config, cards, target_dir)
-            card.save_files()
+        if self.dedup is not None:
+            self.dedup.assign_groups(cards)
+
+        if self.workers > 1:
+            try:
+                self._process_parallel(cards, target_dir)
+            finally:
+                del cards
+                self.card_marker.close()
+
+        else:
+            for card_type in self.card_types:
+                LOGGER.info("Processing using %s ..." % card_type.__name__)
+                card = card_type(self.config, cards, target_dir, self.journal)
+                card.save_files()
+
+        self.save_vector_sheet(target_dir)
 
         LOGGER.info("Image processing finished")
+
+    def save_vector_sheet(self, target_dir: str) -> None:
+        """Собирает векторные оверлеи карт скана (см. `CardType.overlay_formats`)
+        в оверлей всего скана `sheet_tr.svg`."""
+        card_files = []
+
+        for card_type in self.card_types:
+            if "svg" not in card_type.overlay_formats:
+                continue
+
+            pattern = os.path.join(
+                glob.escape(target_dir), card_type.alias, "*", "card_tr.svg"
+            )
+            for svg_fname in glob.glob(pattern):
+                with open(os.path.join(os.path.dirname(svg_fname), "card.json")) as f:
+                    coords = tuple(json.load(f)["coords"])
+                card_files.append((coords, svg_fname))
+
+        if not card_files:
+            return
+
+        size = self.card_marker.image_size
+
+        card_files.sort(key=lambda item: (item[0][1], item[0][0]))
+
+        with atomic_write(os.path.join(target_dir, "sheet_tr.svg")) as f:
+            f.write(get_sheet_svg(card_files, size, self.config.image_dpi))
+
+    def _process_parallel(self, cards: CardsData, target_dir: str) -> None:
+        """Распределяет карты скана между процессами. Процессам передаются только
+        координаты карт, изображения они берут из разделяемой памяти скана."""
+        chunks = {}
+        for idx, card in enumerate(cards):
+            group = card.get("group")
+            key = idx if group is None else ("group", group.id)
+            chunks.setdefault(key, []).append((idx, card["coords"]))
+
+        spec = self.card_marker.buffer.spec
+
+        with ProcessPoolExecutor(self.workers) as executor:
+            for card_type in self.card_types:
+                LOGGER.info(
+                    "Processing using %s in %s processes ..."
+                    % (card_type.__name__, self.workers)
+                )
+                futures = [
+                    executor.submit(
+                        _process_cards_chunk,
+                        self.config,
+                        card_type,
+                        target_dir,
+                        spec,
+                        chunk,
+                        self.journal,
+                    )
+                    for chunk in chunks.values()
+                ]
+                for future in futures:
+                    future.result()
@@ -1,15 +1,21 @@
 import os
-from typing import TypedDict, Protocol
+from typing import TYPE_CHECKING, NotRequired, TypedDict, Protocol
 
 from PIL import Image
 
 from boardtt.config import Config
 from boardtt.logger import LOGGER
+from boardtt.sources import ScanPage
+
+if TYPE_CHECKING:
+    from boardtt.fingerprint import CardGroup
 
 
 class CardData(TypedDict):
     img: Image
     coords: tuple[float, float, float, float]
+    group: NotRequired["CardGroup"]  # группа копий карты, см. `boardtt.fingerprint`
+    idx: NotRequired[int]  # номер карты на скане, если список карт - его часть
 
 
 CardsData = list[CardData]
@@ -20,13 +26,19 @@ class CardMarker(Protocol):
 
 
 class PlanarCardMarker(CardMarker):
-    def __init__(self, config: Config, filepath: str | os.PathLike):
+    def __init__(self, config: Config, filepath: str | os.PathLike | ScanPage):
         self.filepath = filepath
         self.config = config
+        self.image_size: tuple[int, int] | None = None  # известен после `get_cards()`
 
     def _open_image_file(self) -> Image:
         """Возвращает открытый Pillow файл с изображением."""
-        return Image.open(self.filepath)
+        if isinstance(self.filepath, ScanPage):
+            img = self.filepath.open()
+        else:
+            img = Image.open(self.filepath)
+        self.image_size = img.size
+        return img
 
     def _get_card_coords(self, row_num: int, col_num: int) -> tuple[int, int, int, int]:
         """Возвращает координаты карты по её расположению в ряду, колонке."""
@@ -46,16 +58,18 @@ class PlanarCardMarker(CardMarker):
     def get_cards(self) -> CardsData:
         """Возвращает список с данными карт с указанного изображения (скана)."""
         LOGGER.info("Loading cards from %s" % self.filepath)
-        img = self._open_image_file()
 
         cards = []
 
-        for col_num in range(self.config.cards_cols):
-            for row_num in range(self.config.cards_rows):
-                LOGGER.debug("Getting card %s x %s ..." % (col_num + 1, row_num + 1))
-                coords = self._get_card_coords(row_num, col_num)
-                card = img.crop(coords)
-                cards.append({"img": card, "coords": coords})
+        with self._open_image_file() as img:
+            for col_num in range(self.config.cards_cols):
+                for row_num in range(self.config.cards_rows):
+                    LOGGER.debug(
+                        "Getting card %s x %s ..." % (col_num + 1, row_num + 1)
+                    )
+                    coords = self._get_card_coords(row_num, col_num)
+                    card = img.crop(coords)
+                    cards.append({"img": card, "coords": coords})
 
         LOGGER.info("Source image split into %s cards" % len(cards))
 
@@ -0,0 +1,510 @@
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Type, Iterable
+
+from boardtt.card_type import CardType
+from boardtt.config import Config
+from boardtt.exceptions import BGTTException
+from boardtt.logger import LOGGER
+from boardtt.manager import ImageProcessingManager
+from boardtt.sources import iter_scan_pages
+
+
+class QueueFullException(BGTTException):
+    """Очередь заданий заполнена."""
+
+
+class UnknownCardSetException(BGTTException):
+    """Запрошен незарегистрированный набор типов карт."""
+
+
+@dataclass
+class CardTypeSet:
+    """Набор типов карт, зарегистрированный на сервере."""
+
+    config: Config
+    card_types: tuple[Type[CardType], ...]
+
+
+@dataclass
+class Job:
+    """Задание на обработку скана."""
+
+    id: int
+    card_set: str
+    image_path: str
+    priority: int = 0
+    status: str = "queued"  # queued | running | done | failed
+    error: str | None = None
+    submitted_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "card_set": self.card_set,
+            "image_path": self.image_path,
+            "priority": self.priority,
+            "status": self.status,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobQueue:
+    """Очередь заданий с приоритетами и ограниченной глубиной.
+
+    Задания с большим `priority` выбираются раньше, при равных приоритетах
+    соблюдается порядок поступления.
+    """
+
+    def __init__(self, max_depth: int = 100):
+        self.max_depth = max_depth
+        self._queue = queue.PriorityQueue(maxsize=max_depth)
+        self._seq = itertools.count()
+
+    def put(self, job: Job) -> None:
+        """Ставит задание в очередь.
+
+        :raises QueueFullException: если очередь заполнена
+        """
+        try:
+            self._queue.put_nowait((-job.priority, next(self._seq), job))
+        except queue.Full:
+            raise QueueFullException(
+                f"Job queue is full ({self.max_depth} jobs)"
+            ) from None
+
+    def get(self, timeout: float | None = None) -> Job | None:
+        """Возвращает следующее задание или None, если за `timeout` секунд
+        задание так и не появилось."""
+        try:
+            return self._queue.get(timeout=timeout)[2]
+        except queue.Empty:
+            return None
+
+    def task_done(self) -> None:
+        self._queue.task_done()
+
+    def join(self) -> None:
+        self._queue.join()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+
+class WorkerPool:
+    """Пул рабочих потоков, обрабатывающих задания из очереди.
+
+    Потоки живут всё время работы пула, поэтому загруженные ими шрифты
+    (см. `CardType.get_font`) переиспользуются между заданиями.
+    Само распознавание выполняется отдельным процессом Tesseract,
+    так что потоки не упираются в GIL.
+
+    Задания, пишущие в одну директорию (например, два задания на один скан),
+    выполняются по очереди: задание, чья директория занята, откладывается
+    и выполняется потоком, освободившим директорию. Остальные потоки
+    тем временем берут из очереди другие задания.
+    """
+
+    # Сколько завершённых заданий хранить для запросов статуса.
+    history_size = 1000
+
+    def __init__(self, job_queue: JobQueue, workers: int = 2):
+        self.job_queue = job_queue
+        self.workers = workers
+        self.card_sets: dict[str, CardTypeSet] = {}
+        self.jobs: OrderedDict[int, Job] = OrderedDict()
+
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._threads: list[threading.Thread] = []
+        self._stop = threading.Event()
+        # Директории, в которые сейчас пишут выполняющиеся задания,
+        # и отложенные задания для них.
+        self._running_targets: set[str] = set()
+        self._deferred: dict[str, list[Job]] = {}
+
+        self._started_at = time.time()
+        self._busy = 0
+        self._submitted = 0
+        self._rejected = 0
+        self._completed = 0
+        self._failed = 0
+        self._busy_seconds = 0.0
+
+    def register_card_set(
+        self, name: str, config: Config, card_types: Iterable[Type[CardType]]
+    ) -> None:
+        """Регистрирует набор типов карт, на который могут ссылаться задания."""
+        self.card_sets[name] = CardTypeSet(config, tuple(card_types))
+
+    def submit(
+        self, card_set: str, image_path: str | os.PathLike, priority: int = 0
+    ) -> Job:
+        """Создаёт задание и ставит его в очередь.
+
+        :raises UnknownCardSetException: если набор типов карт не зарегистрирован
+        :raises QueueFullException: если очередь заполнена
+        """
+        if card_set not in self.card_sets:
+            raise UnknownCardSetException(f"Unknown card set: {card_set}")
+
+        job = Job(
+            id=next(self._ids),
+            card_set=card_set,
+            image_path=os.fspath(image_path),
+            priority=priority,
+        )
+
+        with self._lock:
+            try:
+                self.job_queue.put(job)
+            except QueueFullException:
+                self._rejected += 1
+                raise
+
+            self._submitted += 1
+            self.jobs[job.id] = job
+            self._trim_history()
+
+        LOGGER.info("Job %s queued: %s" % (job.id, job.image_path))
+        return job
+
+    def get_job(self, job_id: int) -> Job | None:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def _trim_history(self) -> None:
+        """Забывает самые старые завершённые задания сверх `history_size`."""
+        excess = len(self.jobs) - self.history_size
+        if excess <= 0:
+            return
+
+        for job_id in list(self.jobs):
+            if excess <= 0:
+                break
+            if self.jobs[job_id].status in ("done", "failed"):
+                del self.jobs[job_id]
+                excess -= 1
+
+    def start(self) -> None:
+        """Запускает рабочие потоки."""
+        self._stop.clear()
+        for num in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"boardtt-worker-{num + 1}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, wait: bool = True) -> None:
+        """Останавливает рабочие потоки после завершения текущих заданий."""
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            job = self.job_queue.get(timeout=0.2)
+            if job is None or not self._claim_target(job):
+                continue
+
+            while job is not None:
+                try:
+                    self._run_job(job)
+                finally:
+                    self.job_queue.task_done()
+                job = self._release_target(job)
+
+    @staticmethod
+    def _get_target(image_path: str) -> str:
+        """Возвращает директорию, в которую пишет задание (для многостраничных
+        сканов - общую часть имён директорий страниц)."""
+        return os.path.splitext(os.path.realpath(image_path))[0]
+
+    def _claim_target(self, job: Job) -> bool:
+        """Занимает директорию задания. Если она занята другим заданием,
+        откладывает задание. Возвращает булево, указывающее на то, что
+        директория занята для этого задания."""
+        target = self._get_target(job.image_path)
+
+        with self._lock:
+            if target in self._running_targets:
+                LOGGER.info("Job %s deferred, %s is busy" % (job.id, target))
+                self._deferred.setdefault(target, []).append(job)
+                return False
+
+            self._running_targets.add(target)
+            return True
+
+    def _release_target(self, job: Job) -> Job | None:
+        """Освобождает директорию задания. Если для неё есть отложенные задания,
+        директория остаётся занятой и возвращается следующее из них."""
+        target = self._get_target(job.image_path)
+
+        with self._lock:
+            deferred = self._deferred.get(target)
+            if deferred:
+                next_job = deferred.pop(0)
+                if not deferred:
+                    del self._deferred[target]
+                return next_job
+
+            self._running_targets.discard(target)
+            return None
+
+    def _run_job(self, job: Job) -> None:
+        card_set = self.card_sets[job.card_set]
+
+        with self._lock:
+            self._busy += 1
+            job.status = "running"
+            job.started_at = time.time()
+
+        LOGGER.info("Job %s started" % job.id)
+
+        try:
+            for page in iter_scan_pages(job.image_path, card_set.config.image_dpi):
+                ImageProcessingManager(
+                    card_set.config, page, card_set.card_types
+                ).process()
+
+        except Exception as e:
+            LOGGER.exception("Job %s failed" % job.id)
+            status, error = "failed", str(e) or e.__class__.__name__
+
+        else:
+            LOGGER.info("Job %s done" % job.id)
+            status, error = "done", None
+
+        with self._lock:
+            job.finished_at = time.time()
+            job.status = status
+            job.error = error
+
+            self._busy -= 1
+            self._busy_seconds += job.finished_at - job.started_at
+            if status == "done":
+                self._completed += 1
+            else:
+                self._failed += 1
+
+    def get_metrics(self) -> dict:
+        """Возвращает метрики работы пула."""
+        with self._lock:
+            uptime = time.time() - self._started_at
+            finished = self._completed + self._failed
+
+            return {
+                "uptime": uptime,
+                "workers": self.workers,
+                "busy_workers": self._busy,
+                "queue_depth": self.job_queue.depth,
+                "deferred": sum(len(jobs) for jobs in self._deferred.values()),
+                "queue_max_depth": self.job_queue.max_depth,
+                "submitted": self._submitted,
+                "rejected": self._rejected,
+                "completed": self._completed,
+                "failed": self._failed,
+                "jobs_per_minute": finished * 60 / uptime if uptime else 0.0,
+                "avg_job_seconds": self._busy_seconds / finished if finished else 0.0,
+            }
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """Обработчик HTTP-запросов к серверу заданий.
+
+    GET  /card-sets  - зарегистрированные наборы типов карт
+    GET  /jobs       - известные задания
+    GET  /jobs/<id>  - статус задания
+    POST /jobs       - новое задание: {"card_set": ..., "image_path": ..., "priority": 0}
+    GET  /metrics    - метрики пула
+    """
+
+    server_version = "boardtt"
+
+    @property
+    def pool(self) -> WorkerPool:
+        return self.server.pool
+
+    def log_message(self, format, *args):
+        # Для Unix-сокета адреса клиента нет, поэтому не используем address_string().
+        LOGGER.debug("HTTP: " + format % args)
+
+    def _send_json(self, status: HTTPStatus, data, headers=None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: HTTPStatus, message: str, headers=None) -> None:
+        self._send_json(status, {"error": message}, headers)
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+
+        if path == "/metrics":
+            self._send_json(HTTPStatus.OK, self.pool.get_metrics())
+
+        elif path == "/card-sets":
+            self._send_json(
+                HTTPStatus.OK,
+                {
+                    name: [card_type.__name__ for card_type in card_set.card_types]
+                    for name, card_set in self.pool.card_sets.items()
+                },
+            )
+
+        elif path == "/jobs":
+            with self.pool._lock:
+                jobs = [job.as_dict() for job in self.pool.jobs.values()]
+            self._send_json(HTTPStatus.OK, jobs)
+
+        elif path.startswith("/jobs/"):
+            job_id = path[len("/jobs/") :]
+            job = self.pool.get_job(int(job_id)) if job_id.isdigit() else None
+            if job is None:
+                self._send_error(HTTPStatus.NOT_FOUND, "Job not found")
+            else:
+                self._send_json(HTTPStatus.OK, job.as_dict())
+
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, "Not found")
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send_error(HTTPStatus.NOT_FOUND, "Not found")
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            card_set = payload["card_set"]
+            image_path = payload["image_path"]
+            priority = payload.get("priority", 0)
+            if not isinstance(card_set, str):
+                raise TypeError("card_set must be a string")
+            if not isinstance(image_path, str):
+                raise TypeError("image_path must be a string")
+            if not isinstance(priority, int) or isinstance(priority, bool):
+                raise TypeError("priority must be an integer")
+
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, f"Invalid job payload: {e}")
+            return
+
+        if not os.path.isfile(image_path):
+            self._send_error(HTTPStatus.BAD_REQUEST, f"No such file: {image_path}")
+            return
+
+        try:
+            job = self.pool.submit(card_set, image_path, priority)
+
+        except UnknownCardSetException as e:
+            self._send_error(HTTPStatus.NOT_FOUND, str(e))
+
+        except QueueFullException as e:
+            self._send_error(
+                HTTPStatus.SERVICE_UNAVAILABLE, str(e), headers={"Retry-After": "5"}
+            )
+
+        else:
+            self._send_json(HTTPStatus.ACCEPTED, job.as_dict())
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    """HTTP-сервер, слушающий Unix-сокет."""
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler ожидает адрес клиента в виде кортежа.
+        return request, ("local", 0)
+
+
+class JobServer:
+    """Локальный сервер заданий на обработку сканов.
+
+    Пример::
+
+        server = JobServer(workers=4, max_depth=50)
+        server.register_card_set("lure", config, (StarWarsLureEnhance, StarWarsLureEvent))
+        server.serve_forever()  # http://127.0.0.1:8740/
+
+    :param host: Адрес для прослушивания (HTTP)
+    :param port: Порт для прослушивания (HTTP). 0 - выбрать свободный.
+    :param unix_socket: Путь к Unix-сокету. Если указан, `host` и `port` не используются.
+    :param workers: Количество рабочих потоков
+    :param max_depth: Максимальное количество заданий, ожидающих в очереди
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8740,
+        unix_socket: str | os.PathLike | None = None,
+        workers: int = 2,
+        max_depth: int = 100,
+    ):
+        self.pool = WorkerPool(JobQueue(max_depth), workers=workers)
+        self.unix_socket = unix_socket
+
+        if unix_socket is not None:
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            self.httpd = UnixHTTPServer(os.fspath(unix_socket), JobRequestHandler)
+        else:
+            self.httpd = ThreadingHTTPServer((host, port), JobRequestHandler)
+
+        self.httpd.pool = self.pool
+
+    @property
+    def address(self) -> str:
+        """Адрес, на котором принимаются запросы."""
+        if self.unix_socket is not None:
+            return os.fspath(self.unix_socket)
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def register_card_set(
+        self, name: str, config: Config, card_types: Iterable[Type[CardType]]
+    ) -> None:
+        """Регистрирует набор типов карт под указанным именем."""
+        self.pool.register_card_set(name, config, card_types)
+
+    def serve_forever(self) -> None:
+        """Запускает пул и обрабатывает запросы до вызова `shutdown()`."""
+        self.pool.start()
+        LOGGER.info("Job server listening on %s" % self.address)
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
+            self.pool.stop()
+            if self.unix_socket is not None and os.path.exists(self.unix_socket):
+                os.unlink(self.unix_socket)
+
+    def shutdown(self) -> None:
+        """Останавливает сервер. Вызывается из другого потока."""
+        self.httpd.shutdown()
@@ -0,0 +1,365 @@
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Type, Iterable
+
+from boardtt.card_type import CardType
+from boardtt.config import Config
+from boardtt.exceptions import BGTTException
+from boardtt.logger import LOGGER
+from boardtt.manager import ImageProcessingManager
+from boardtt.sources import SCAN_SUFFIXES, iter_scan_pages
+from boardtt.utils import atomic_write
+
+
+class LeaseLostException(BGTTException):
+    """Аренда скана истекла и была перехвачена другим обработчиком."""
+
+
+class Lease:
+    """Аренда скана обработчиком. Пока обработчик жив, он должен
+    регулярно вызывать `heartbeat()`, иначе аренда будет считаться истёкшей.
+    """
+
+    def __init__(self, path: Path, scan: Path, worker_id: str, token: str):
+        self.path = path
+        self.scan = scan
+        self.worker_id = worker_id
+        self.token = token
+
+    def is_owned(self) -> bool:
+        """Возвращает булево, указывающее на то, принадлежит ли аренда всё ещё нам."""
+        return _read_lease(self.path).get("token") == self.token
+
+    def heartbeat(self) -> None:
+        """Продлевает аренду.
+
+        :raises LeaseLostException: если аренду перехватил другой обработчик
+        """
+        if not self.is_owned():
+            raise LeaseLostException(f"Lease on {self.scan.name} lost")
+        os.utime(self.path)
+
+
+def _read_lease(path: Path) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+class FilesystemJobQueue:
+    """Очередь сканов на разделяемой (например, NFS) файловой системе.
+
+    Состояние очереди хранится в служебной директории рядом со сканами:
+    `<scan>.lease` - скан арендован обработчиком, `<scan>.done` - скан обработан,
+    `<scan>.failed` - обработка скана завершилась ошибкой.
+
+    Аренды захватываются эксклюзивным созданием файла, поэтому скан обрабатывает
+    только один обработчик. Аренда, не продлевавшаяся дольше `lease_ttl` секунд,
+    считается брошенной (обработчик упал) и может быть перехвачена.
+    Часы узлов должны быть синхронизированы (NTP).
+
+    :param source_dir: Директория со сканами
+    :param queue_dir: Служебная директория очереди. По умолчанию `<source_dir>/.boardtt-queue`
+    :param lease_ttl: Время жизни аренды без продления, в секундах
+    """
+
+    def __init__(
+        self,
+        source_dir: str | os.PathLike,
+        queue_dir: str | os.PathLike | None = None,
+        lease_ttl: float = 60,
+    ):
+        self.source_dir = Path(source_dir)
+        self.queue_dir = Path(queue_dir or self.source_dir / ".boardtt-queue")
+        self.lease_ttl = lease_ttl
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_scans(self) -> list[Path]:
+        """Возвращает отсортированный список сканов в директории."""
+        return sorted(
+            f
+            for f in self.source_dir.iterdir()
+            if f.is_file() and f.suffix.lower() in SCAN_SUFFIXES
+        )
+
+    def _marker(self, scan: Path, kind: str) -> Path:
+        return self.queue_dir / f"{scan.name}.{kind}"
+
+    def is_finished(self, scan: Path) -> bool:
+        """Возвращает булево, указывающее на то, что скан обработан (успешно или нет)."""
+        return (
+            self._marker(scan, "done").exists() or self._marker(scan, "failed").exists()
+        )
+
+    def get_pending(self) -> list[Path]:
+        """Возвращает список ещё не обработанных сканов."""
+        return [scan for scan in self.get_scans() if not self.is_finished(scan)]
+
+    def _is_expired(self, lease_path: Path) -> bool:
+        try:
+            return time.time() - lease_path.stat().st_mtime > self.lease_ttl
+        except FileNotFoundError:
+            return False
+
+    def _break_lease(self, lease_path: Path) -> None:
+        """Снимает брошенную аренду.
+
+        Файл аренды сначала атомарно переименовывается: из нескольких
+        обработчиков, одновременно решивших снять аренду, это удастся одному.
+        """
+        stale = _read_lease(lease_path)
+        grave = lease_path.with_name(f"{lease_path.name}.{uuid.uuid4().hex}.stale")
+        try:
+            os.rename(lease_path, grave)
+        except FileNotFoundError:
+            return
+
+        if _read_lease(grave).get("token") != stale.get("token"):
+            # Между проверкой и переименованием аренду успели захватить заново.
+            # Возвращаем её владельцу, если место ещё свободно.
+            try:
+                os.link(grave, lease_path)
+            except FileExistsError:
+                pass
+        else:
+            LOGGER.warning(
+                "Breaking expired lease of %s on %s"
+                % (stale.get("worker"), lease_path.name)
+            )
+
+        grave.unlink(missing_ok=True)
+
+    def claim(self, scan: Path, worker_id: str) -> Lease | None:
+        """Пытается арендовать скан. Возвращает аренду или None,
+        если скан уже обработан или арендован другим обработчиком."""
+        if self.is_finished(scan):
+            return None
+
+        lease_path = self._marker(scan, "lease")
+
+        if self._is_expired(lease_path):
+            self._break_lease(lease_path)
+
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return None
+
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": worker_id, "token": token, "since": time.time()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Скан мог быть завершён другим обработчиком, пока мы создавали аренду.
+        if self.is_finished(scan):
+            lease_path.unlink(missing_ok=True)
+            return None
+
+        return Lease(lease_path, scan, worker_id, token)
+
+    def _finish(self, lease: Lease, kind: str, data: dict) -> None:
+        """Записывает маркер завершения обработки скана и освобождает аренду.
+
+        :raises LeaseLostException: если аренду перехватил другой обработчик -
+            скан теперь обрабатывает он, и маркер не записывается
+        """
+        if not lease.is_owned():
+            raise LeaseLostException(f"Lease on {lease.scan.name} lost")
+
+        with atomic_write(self._marker(lease.scan, kind)) as f:
+            json.dump(dict(data, worker=lease.worker_id, at=time.time()), f)
+        self.release(lease)
+
+    def complete(self, lease: Lease) -> None:
+        """Отмечает арендованный скан обработанным и освобождает аренду.
+
+        :raises LeaseLostException: если аренда нам больше не принадлежит
+        """
+        self._finish(lease, "done", {})
+
+    def fail(self, lease: Lease, error: str) -> None:
+        """Отмечает обработку арендованного скана неудачной и освобождает аренду.
+
+        :raises LeaseLostException: если аренда нам больше не принадлежит
+        """
+        self._finish(lease, "failed", {"error": error})
+
+    def release(self, lease: Lease) -> None:
+        """Освобождает аренду, если она всё ещё принадлежит нам."""
+        if lease.is_owned():
+            lease.path.unlink(missing_ok=True)
+
+
+class ShardWorker:
+    """Обработчик сканов из общей директории.
+
+    Запускается на каждом узле (или в нескольких процессах на одном узле);
+    обработчики делят сканы между собой через `FilesystemJobQueue`.
+
+    :param source_dir: Директория со сканами
+    :param config: Конфигурация сканов
+    :param card_types: Типы карт
+    :param worker_id: Идентификатор обработчика. По умолчанию `<хост>-<pid>`
+    :param lease_ttl: Время жизни аренды без продления, в секундах
+    :param poll_interval: Пауза между проверками очереди, когда свободных сканов нет
+    """
+
+    def __init__(
+        self,
+        source_dir: str | os.PathLike,
+        config: Config,
+        card_types: Iterable[Type[CardType]],
+        worker_id: str | None = None,
+        lease_ttl: float = 60,
+        poll_interval: float = 5,
+    ):
+        self.queue = FilesystemJobQueue(source_dir, lease_ttl=lease_ttl)
+        self.config = config
+        self.card_types = tuple(card_types)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.poll_interval = poll_interval
+
+    def _keep_alive(
+        self, lease: Lease, stop: threading.Event, lost: threading.Event
+    ) -> None:
+        """Продлевает аренду, пока идёт обработка скана.
+        Если аренду перехватили, устанавливает `lost`."""
+        while not stop.wait(self.queue.lease_ttl / 3):
+            try:
+                lease.heartbeat()
+            except LeaseLostException:
+                LOGGER.error(
+                    "Worker %s lost lease on %s" % (self.worker_id, lease.scan)
+                )
+                lost.set()
+                return
+
+    def process_scan(self, lease: Lease) -> bool:
+        """Обрабатывает арендованный скан.
+
+        Если аренду перехватил другой обработчик, обработка прекращается
+        перед следующей страницей скана, а маркер завершения не записывается.
+        Возвращает булево, указывающее на то, что обработку скана завершил
+        этот обработчик.
+        """
+        LOGGER.info("Worker %s processing %s" % (self.worker_id, lease.scan))
+
+        stop = threading.Event()
+        lost = threading.Event()
+        keeper = threading.Thread(
+            target=self._keep_alive, args=(lease, stop, lost), daemon=True
+        )
+        keeper.start()
+
+        error = None
+        try:
+            for page in iter_scan_pages(lease.scan, self.config.image_dpi):
+                if lost.is_set():
+                    raise LeaseLostException(f"Lease on {lease.scan.name} lost")
+                ImageProcessingManager(self.config, page, self.card_types).process()
+
+        except LeaseLostException:
+            LOGGER.error(
+                "Worker %s abandoned %s, it is processed by another worker"
+                % (self.worker_id, lease.scan)
+            )
+            return False
+
+        except Exception as e:
+            LOGGER.exception("Worker %s failed on %s" % (self.worker_id, lease.scan))
+            error = str(e) or e.__class__.__name__
+
+        finally:
+            stop.set()
+            keeper.join()
+
+        try:
+            if error is None:
+                self.queue.complete(lease)
+            else:
+                self.queue.fail(lease, error)
+
+        except LeaseLostException:
+            LOGGER.error(
+                "Worker %s lost lease on %s before finishing it, status not recorded"
+                % (self.worker_id, lease.scan)
+            )
+            return False
+
+        return True
+
+    def run(self) -> int:
+        """Обрабатывает сканы, пока в директории остаются необработанные.
+        Возвращает количество сканов, обработанных этим обработчиком."""
+        processed = 0
+
+        while True:
+            pending = self.queue.get_pending()
+            if not pending:
+                break
+
+            claimed = False
+            for scan in pending:
+                lease = self.queue.claim(scan, self.worker_id)
+                if lease is None:
+                    continue
+                claimed = True
+                if self.process_scan(lease):
+                    processed += 1
+
+            if not claimed:
+                # Все оставшиеся сканы заняты другими обработчиками. Ждём,
+                # пока они закончат или их аренды истекут.
+                time.sleep(self.poll_interval)
+
+        LOGGER.info(
+            "Worker %s finished, %s scan(s) processed" % (self.worker_id, processed)
+        )
+        return processed
+
+
+def _run_worker(source_dir, config, card_types, worker_id, lease_ttl, poll_interval):
+    return ShardWorker(
+        source_dir, config, card_types, worker_id, lease_ttl, poll_interval
+    ).run()
+
+
+def run_workers(
+    source_dir: str | os.PathLike,
+    config: Config,
+    card_types: Iterable[Type[CardType]],
+    processes: int = 2,
+    lease_ttl: float = 60,
+    poll_interval: float = 5,
+) -> int:
+    """Запускает несколько обработчиков в отдельных процессах этого узла
+    и дожидается их завершения. Возвращает общее количество обработанных сканов."""
+    card_types = tuple(card_types)
+    host = socket.gethostname()
+
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.starmap(
+            _run_worker,
+            [
+                (
+                    source_dir,
+                    config,
+                    card_types,
+                    f"{host}-{num + 1}",
+                    lease_ttl,
+                    poll_interval,
+                )
+                for num in range(processes)
+            ],
+        )
+
+    return sum(results)
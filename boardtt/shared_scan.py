@@ -0,0 +1,172 @@
+import gc
+import os
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+from PIL import Image
+
+from boardtt.config import Config
+from boardtt.logger import LOGGER
+from boardtt.marker import CardsData, PlanarCardMarker
+from boardtt.sources import ScanPage
+
+
+# Режимы, изображения в которых Pillow умеет отображать на внешний буфер без копирования.
+_MAPPABLE_MODES = {"L": 1, "RGBX": 4, "RGBA": 4}
+
+# Сколько строк изображения копировать в разделяемую память за раз.
+_ROWS_PER_CHUNK = 256
+
+
+@dataclass(frozen=True)
+class ScanBufferSpec:
+    """Сведения, достаточные для подключения к буферу скана из другого процесса."""
+
+    name: str
+    size: tuple[int, int]
+    mode: str
+
+    @property
+    def stride(self) -> int:
+        """Длина строки изображения в байтах."""
+        return self.size[0] * _MAPPABLE_MODES[self.mode]
+
+
+class SharedScanBuffer:
+    """Декодированный скан в разделяемой памяти.
+
+    Скан декодируется и копируется в разделяемую память один раз, после чего
+    любой процесс может подключиться к буферу по `spec` и получить изображения
+    карт и регионов без копирования (см. `view()`).
+    """
+
+    def __init__(
+        self, shm: shared_memory.SharedMemory, spec: ScanBufferSpec, owner: bool
+    ):
+        self.shm = shm
+        self.spec = spec
+        self.owner = owner
+
+    @classmethod
+    def create(cls, img: Image.Image) -> "SharedScanBuffer":
+        """Размещает изображение в новом буфере разделяемой памяти."""
+        mode = img.mode
+        if mode not in _MAPPABLE_MODES:
+            mode = "RGBA" if "A" in img.getbands() else "RGBX"
+
+        width, height = img.size
+        stride = width * _MAPPABLE_MODES[mode]
+
+        shm = shared_memory.SharedMemory(create=True, size=max(stride * height, 1))
+        spec = ScanBufferSpec(shm.name, img.size, mode)
+
+        # Копируем и преобразуем полосами, чтобы не держать в памяти
+        # ещё одну полную копию скана.
+        for top in range(0, height, _ROWS_PER_CHUNK):
+            bottom = min(top + _ROWS_PER_CHUNK, height)
+            strip = img.crop((0, top, width, bottom))
+            if strip.mode != mode:
+                strip = strip.convert(mode)
+            shm.buf[top * stride : bottom * stride] = strip.tobytes()
+
+        LOGGER.debug(
+            "Scan placed into shared memory `%s` (%s bytes)" % (shm.name, shm.size)
+        )
+        return cls(shm, spec, owner=True)
+
+    @classmethod
+    def attach(cls, spec: ScanBufferSpec) -> "SharedScanBuffer":
+        """Подключается к существующему буферу."""
+        return cls(shared_memory.SharedMemory(name=spec.name), spec, owner=False)
+
+    def view(self, coords: tuple[int, int, int, int] | None = None) -> Image.Image:
+        """Возвращает изображение области скана, отображённое на буфер без копирования.
+
+        Изображение доступно только для чтения: изменяющие операции Pillow
+        работают с его копией.
+
+        :param coords: Координаты области (x, y, x1, y1). По умолчанию - весь скан.
+        """
+        spec = self.spec
+        if coords is None:
+            coords = (0, 0, *spec.size)
+
+        x, y, x1, y1 = coords
+        x, y = max(x, 0), max(y, 0)
+        x1, y1 = min(x1, spec.size[0]), min(y1, spec.size[1])
+        pixel_size = _MAPPABLE_MODES[spec.mode]
+        start = y * spec.stride + x * pixel_size
+
+        if start + (y1 - y) * spec.stride > len(self.shm.buf):
+            # Последняя строка области не дотягивает до полной длины строки,
+            # отображение с таким шагом невозможно - копируем только эту область.
+            return self.view((0, y, spec.size[0], y1)).crop((x, 0, x1, y1 - y))
+
+        return Image.frombuffer(
+            spec.mode,
+            (x1 - x, y1 - y),
+            self.shm.buf[start:],
+            "raw",
+            spec.mode,
+            spec.stride,
+            1,
+        )
+
+    def close(self) -> None:
+        """Отключается от буфера. Владелец буфера также освобождает его."""
+        try:
+            self.shm.close()
+        except BufferError:
+            # Ещё живы изображения, отображённые на буфер. Они могут быть
+            # частью циклических ссылок, поэтому пробуем собрать мусор.
+            gc.collect()
+            try:
+                self.shm.close()
+            except BufferError:
+                LOGGER.warning("Shared memory `%s` is still in use" % self.spec.name)
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SharedScanCardMarker(PlanarCardMarker):
+    """Разметчик, размещающий скан в разделяемой памяти.
+
+    Изображения карт - отображения на буфер скана без копирования, поэтому
+    карты одного скана можно обрабатывать в нескольких процессах, передавая
+    им только `buffer.spec` и координаты.
+    """
+
+    def __init__(self, config: Config, filepath: str | os.PathLike | ScanPage):
+        super().__init__(config, filepath)
+        self.buffer: SharedScanBuffer | None = None
+
+    def get_cards(self) -> CardsData:
+        """Возвращает список с данными карт с указанного изображения (скана)."""
+        LOGGER.info("Loading cards from %s" % self.filepath)
+
+        if self.buffer is None:
+            with self._open_image_file() as img:
+                self.buffer = SharedScanBuffer.create(img)
+
+        cards = []
+
+        for col_num in range(self.config.cards_cols):
+            for row_num in range(self.config.cards_rows):
+                coords = self._get_card_coords(row_num, col_num)
+                cards.append({"img": self.buffer.view(coords), "coords": coords})
+
+        LOGGER.info("Source image split into %s cards" % len(cards))
+
+        return cards
+
+    def close(self) -> None:
+        """Освобождает разделяемую память скана."""
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
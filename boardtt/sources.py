@@ -0,0 +1,130 @@
+import io
+import os
+import re
+import subprocess
+from dataclasses import dataclass
+from typing import Iterator
+
+from PIL import Image
+
+from boardtt.exceptions import BGTTException
+from boardtt.logger import LOGGER
+
+
+# Расширения файлов, которые могут быть сканами.
+SCAN_SUFFIXES = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".pdf")
+
+RE_PDF_PAGES = re.compile(r"^Pages:\s+(\d+)", re.MULTILINE)
+
+
+class ScanSourceException(BGTTException):
+    """Исключения чтения сканов."""
+
+
+@dataclass(frozen=True)
+class ScanPage:
+    """Страница скана: отдельное изображение или страница многостраничного
+    файла (TIFF, PDF). Каждая страница обрабатывается как отдельный скан.
+
+    Объект содержит только путь и номер страницы, поэтому его дёшево передавать
+    в другие процессы: изображение декодируется при вызове `open()`.
+    """
+
+    path: str
+    index: int | None = None  # номер страницы (с 0); None - файл не многостраничный
+    dpi: int = 300  # разрешение, с которым растеризуются страницы PDF
+
+    @property
+    def name(self) -> str:
+        """Имя страницы для журналов и сообщений."""
+        filename = os.path.basename(self.path)
+        if self.index is None:
+            return filename
+        return f"{filename}#{self.index + 1:04d}"
+
+    @property
+    def target_dir(self) -> str:
+        """Директория для материалов локализации страницы."""
+        base = os.path.splitext(self.path)[0]
+        if self.index is None:
+            return base
+        return f"{base}-p{self.index + 1:04d}"
+
+    def open(self) -> Image.Image:
+        """Декодирует и возвращает изображение страницы."""
+        if self.path.lower().endswith(".pdf"):
+            return _render_pdf_page(self.path, self.index or 0, self.dpi)
+
+        img = Image.open(self.path)
+        if self.index:
+            img.seek(self.index)
+        return img
+
+    def __str__(self):
+        return self.name
+
+
+def _run(args: list[str]) -> bytes:
+    try:
+        return subprocess.run(args, capture_output=True, check=True).stdout
+    except FileNotFoundError as e:
+        raise ScanSourceException(
+            f"{args[0]} not found, install poppler-utils to read PDF scans"
+        ) from e
+    except subprocess.CalledProcessError as e:
+        raise ScanSourceException(
+            f"{args[0]} error: {e.stderr.decode('utf-8', 'replace').strip()}"
+        ) from e
+
+
+def _count_pdf_pages(path: str) -> int:
+    match = RE_PDF_PAGES.search(_run(["pdfinfo", path]).decode("utf-8", "replace"))
+    if match is None:
+        raise ScanSourceException(f"Unable to get page count of {path}")
+    return int(match.group(1))
+
+
+def _render_pdf_page(path: str, index: int, dpi: int) -> Image.Image:
+    """Растеризует одну страницу PDF, не создавая промежуточных файлов."""
+    page = str(index + 1)
+    data = _run(
+        [
+            "pdftoppm",
+            "-r",
+            str(dpi),
+            "-f",
+            page,
+            "-l",
+            page,
+            "-singlefile",
+            "-png",
+            path,
+            "-",
+        ]
+    )
+    return Image.open(io.BytesIO(data))
+
+
+def iter_scan_pages(path: str | os.PathLike, dpi: int = 300) -> Iterator[ScanPage]:
+    """Перебирает страницы скана. Изображения страниц не декодируются -
+    для многостраничных файлов читаются только их заголовки.
+
+    :param path: Путь к файлу скана
+    :param dpi: Разрешение, с которым растеризуются страницы PDF
+    """
+    path = os.fspath(path)
+
+    if path.lower().endswith(".pdf"):
+        pages_count = _count_pdf_pages(path)
+    else:
+        with Image.open(path) as img:
+            pages_count = getattr(img, "n_frames", 1)
+
+    if pages_count == 1:
+        yield ScanPage(path, dpi=dpi)
+        return
+
+    LOGGER.info("%s contains %s pages" % (path, pages_count))
+
+    for index in range(pages_count):
+        yield ScanPage(path, index, dpi)
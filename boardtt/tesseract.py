@@ -1,9 +1,26 @@
+from dataclasses import dataclass
+
 from PIL import Image
 from pytesseract import pytesseract
 
 from boardtt.exceptions import TesseractException
 
 
+@dataclass
+class Recognized:
+    """Результат распознавания с оценкой уверенности."""
+
+    text: str
+    confidences: list[float]
+
+    @property
+    def confidence(self) -> float:
+        """Средняя уверенность распознавания слов (0-100). 0, если слов не найдено."""
+        if not self.confidences:
+            return 0.0
+        return sum(self.confidences) / len(self.confidences)
+
+
 class TesseractAPI:
     LANG = "eng"
 
@@ -18,3 +35,44 @@ class TesseractAPI:
             return pytesseract.image_to_string(img, lang=cls.LANG)
         except OSError as e:
             raise TesseractException(f"Tessaract error: {e}") from e
+
+    @classmethod
+    def recognize_words(cls, img: Image) -> Recognized:
+        """Распознаёт текст на данном изображении, возвращая также
+        уверенность распознавания каждого слова (из TSV-вывода Tesseract)."""
+        try:
+            data = pytesseract.image_to_data(
+                img, lang=cls.LANG, output_type=pytesseract.Output.DICT
+            )
+        except OSError as e:
+            raise TesseractException(f"Tessaract error: {e}") from e
+
+        lines = {}
+        confidences = []
+
+        for idx, word in enumerate(data["text"]):
+            conf = float(data["conf"][idx])
+            word = word.strip()
+            if conf < 0 or not word:  # Строки уровней страницы, блока и т.п.
+                continue
+
+            line_key = (
+                data["block_num"][idx],
+                data["par_num"][idx],
+                data["line_num"][idx],
+            )
+            lines.setdefault(line_key, []).append(word)
+            confidences.append(conf)
+
+        # Как и в выводе `image_to_string`, абзацы и блоки разделяются пустой строкой.
+        text_lines = []
+        paragraph = None
+        for (block_num, par_num, _), words in lines.items():
+            if paragraph is not None and paragraph != (block_num, par_num):
+                text_lines.append("")
+            paragraph = (block_num, par_num)
+            text_lines.append(" ".join(words))
+
+        text = "\n".join(text_lines)
+
+        return Recognized(text, confidences)
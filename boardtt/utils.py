@@ -1,2 +1,36 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from PIL import Image
+
+
 def mm_to_pixels(mm: int | float, dpi: int | float = 300) -> int:
     return int((dpi * mm) / 25.4)
+
+
+@contextmanager
+def atomic_write(path: str | os.PathLike, mode: str = "w"):
+    """Открывает временный файл для записи и по завершении блока атомарно
+    подменяет им файл `path`. При ошибке `path` остаётся нетронутым."""
+    path = os.fspath(path)
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def save_image(img: Image.Image, path: str | os.PathLike) -> None:
+    """Атомарно сохраняет изображение. Формат определяется по расширению."""
+    img_format = Image.registered_extensions()[os.path.splitext(path)[1].lower()]
+    # Изображения из разделяемой памяти (см. `boardtt.shared_scan`).
+    if img.mode == "RGBX":
+        img = img.convert("RGB")
+    with atomic_write(path, "wb") as f:
+        img.save(f, format=img_format)
@@ -0,0 +1,174 @@
+import os
+import re
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+
+from PIL import ImageStat
+
+from boardtt.logger import LOGGER
+
+
+SVG_NS = "http://www.w3.org/2000/svg"
+
+ElementTree.register_namespace("", SVG_NS)
+
+RE_FONT_FACE = re.compile(
+    r'font-family: "([^"]+)"; src: local\([^)]*\), url\("file://([^"]+)"\)'
+)
+
+
+def _px_to_mm(px: int | float, dpi: int | float) -> str:
+    return f"{px * 25.4 / dpi:.3f}mm"
+
+
+def _get_face_name(font) -> str:
+    """Возвращает полное имя начертания шрифта (например, `Ubuntu Medium`).
+
+    По одному имени семейства `local()` нашёл бы обычное начертание, а размер
+    текста подобран под конкретное, поэтому каждое начертание описывается
+    отдельным семейством со своим полным именем.
+    """
+    family, style = font.getname()
+    if not style or style in ("Regular", "Book", "Normal", "Roman"):
+        return family
+    return f"{family} {style}"
+
+
+def _get_font_faces(fonts: dict) -> str:
+    """Возвращает CSS с описаниями шрифтов (`@font-face`)."""
+    return "\n".join(
+        "@font-face { font-family: %s; src: local(%s), url(%s); }"
+        % (quoteattr(family), quoteattr(family), quoteattr(f"file://{path}"))
+        for family, path in fonts.items()
+    )
+
+
+def make_svg(body: str, size: tuple[int, int], dpi: int | float, fonts: dict) -> str:
+    """Возвращает SVG-документ. Единица пользовательских координат - пиксел скана,
+    физический размер документа соответствует размеру на скане.
+
+    :param body: Содержимое документа
+    :param size: Размер документа (ширина, высота) в пикселах скана
+    :param dpi: Разрешение скана
+    :param fonts: Используемые шрифты: {полное имя начертания: путь к файлу}
+    """
+    width, height = size
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg xmlns="{SVG_NS}" width="{_px_to_mm(width, dpi)}" height="{_px_to_mm(height, dpi)}"'
+        f' viewBox="0 0 {width} {height}">\n'
+        f"<style>\n{_get_font_faces(fonts)}\n</style>\n"
+        f"{body}"
+        "</svg>\n"
+    )
+
+
+def get_card_svg(card_type, card, dpi: int | float) -> str:
+    """Возвращает векторный оверлей карты в формате SVG.
+
+    Текст регионов выводится текстом, тем же шрифтом, размером и с тем же
+    разворотом, что и в растровом оверлее (`CardType.get_tr_image`), поверх
+    прямоугольника цвета подложки региона.
+
+    :param CardType card_type: Тип карты
+    :param dict card: Словарь с данными карты
+    :param dpi: Разрешение скана
+    """
+    card_coords = card["coords"]
+    size = (card_coords[2] - card_coords[0], card_coords[3] - card_coords[1])
+
+    fonts = {}
+    parts = []
+
+    for area_name, area_data in card["areas"].items():
+        if not area_data["render"]:
+            continue
+
+        rotate = area_data["rotate"]
+        x, y, x1, y1 = area_data["coords"]
+        width, height = x1 - x, y1 - y
+        text_width, text_height = width, height
+        if rotate is not None:
+            text_width, text_height = height, width
+
+        text = area_data["str"]
+        font, text_x, text_y = card_type.adjust_text_to_box(
+            text, text_height, text_width
+        )
+        family = _get_face_name(font)
+        fonts[family] = os.path.abspath(font.path)
+
+        # Цвет подложки - средний цвет образца подложки региона.
+        red, green, blue, alpha = (
+            round(channel) for channel in ImageStat.Stat(area_data["img_bg"]).mean
+        )
+
+        ascent = font.getmetrics()[0]
+        line_height = card_type.get_line_height(font)
+        lines = "".join(
+            f'<tspan x="{text_x}" y="{text_y + ascent + num * line_height:g}">'
+            f"{escape(line)}</tspan>"
+            for num, line in enumerate(text.splitlines())
+        )
+
+        # Растровый оверлей рисует текст на развёрнутой подложке и разворачивает
+        # её обратно относительно центра: в SVG это поворот на `rotate` по часовой.
+        text_transform = ""
+        if rotate is not None:
+            text_transform = (
+                f' transform="rotate({rotate} {width / 2:g} {height / 2:g})"'
+            )
+
+        clip_id = f"clip-{area_name}"
+        parts.append(
+            f'<g id={quoteattr(area_name)} transform="translate({x} {y})"'
+            f' clip-path="url(#{clip_id})">\n'
+            f'<clipPath id="{clip_id}"><rect width="{width}" height="{height}"/></clipPath>\n'
+            f'<rect width="{width}" height="{height}" fill="rgb({red},{green},{blue})"'
+            f' fill-opacity="{alpha / 255:.3f}"/>\n'
+            f'<text font-family={quoteattr(family)} font-size="{font.size}"'
+            f' fill="#000" xml:space="preserve"{text_transform}>{lines}</text>\n'
+            "</g>\n"
+        )
+
+    return make_svg("".join(parts), size, dpi, fonts)
+
+
+def get_sheet_svg(
+    card_files: list[tuple[tuple[int, int, int, int], str]],
+    size: tuple[int, int],
+    dpi: int | float,
+) -> str:
+    """Собирает векторные оверлеи карт в оверлей всего скана.
+
+    :param card_files: Список кортежей (координаты карты на скане, путь к SVG карты)
+    :param size: Размер скана в пикселах
+    :param dpi: Разрешение скана
+    """
+    fonts = {}
+    parts = []
+
+    for num, (coords, path) in enumerate(card_files):
+        card_svg = ElementTree.parse(path).getroot()
+
+        for style in card_svg.findall(f"{{{SVG_NS}}}style"):
+            fonts.update(RE_FONT_FACE.findall(style.text or ""))
+            card_svg.remove(style)
+
+        # Идентификаторы должны быть уникальны в пределах документа.
+        for element in card_svg.iter():
+            if "id" in element.attrib:
+                element.set("id", f"c{num}-{element.get('id')}")
+            clip_path = element.get("clip-path")
+            if clip_path:
+                element.set("clip-path", clip_path.replace("url(#", f"url(#c{num}-"))
+
+        card_svg.set("x", str(coords[0]))
+        card_svg.set("y", str(coords[1]))
+        card_svg.set("width", str(coords[2] - coords[0]))
+        card_svg.set("height", str(coords[3] - coords[1]))
+        parts.append(ElementTree.tostring(card_svg, encoding="unicode") + "\n")
+
+    LOGGER.info("Vector overlay sheet assembled from %s cards" % len(card_files))
+
+    return make_svg("".join(parts), size, dpi, fonts)
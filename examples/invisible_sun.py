@@ -1,9 +1,11 @@
 from pathlib import Path
 
-from boardtt.manager import ImageProcessingManager
+from boardtt.batch import get_arg_parser, process_directory
 from boardtt.card_type import CardType
 from boardtt.card_area import CardArea
 from boardtt.config import Config
+from boardtt.fingerprint import CardDeduplicator
+from boardtt.sources import SCAN_SUFFIXES
 
 
 class Base(CardType):
@@ -20,12 +22,19 @@ class RegularCard(Base):
 
 SOURCE_DIR = Path(__file__).parent.parent / "sources" / Path(__file__).stem
 IMAGE_NAMES_IN_DIR = [
-    f for f in SOURCE_DIR.iterdir() if f.is_file() and f.suffix in [".jpg", ".png"]
+    f for f in SOURCE_DIR.iterdir() if f.is_file() and f.suffix in SCAN_SUFFIXES
 ]
 FIRST_IMAGE = SOURCE_DIR / IMAGE_NAMES_IN_DIR[0]
 
+# Копии карт распознаются один раз на весь проект.
+DEDUP = CardDeduplicator()
+
+
+# Обработка запускается только при запуске модуля как скрипта: при запуске
+# дочерних процессов методом spawn/forkserver модуль импортируется в каждом из них.
+if __name__ == "__main__":
+    ARGS = get_arg_parser().parse_args()
 
-for image_name in IMAGE_NAMES_IN_DIR:
     config = Config(
         image_dpi=300,
         card_height_mm=89,
@@ -37,6 +46,13 @@ for image_name in IMAGE_NAMES_IN_DIR:
         offset_from_top_border_mm=17,
         offset_from_left_border_mm=7,
     )
-    ImageProcessingManager(
-        config=config, image_path=SOURCE_DIR / image_name, card_types=(RegularCard,)
-    ).process()
+    process_directory(
+        SOURCE_DIR,
+        config=config,
+        card_types=(RegularCard,),
+        resume=ARGS.resume,  # python -m examples.invisible_sun --resume
+        max_attempts=ARGS.max_attempts,
+        dedup=DEDUP,
+        workers=ARGS.workers,
+        page_workers=ARGS.page_workers,
+    )
@@ -67,13 +67,11 @@ class StarWarsLureObjective(StarWarsLure):
 IMAGE_PATH = "sw1.png"  # Put your path here.
 
 ###################################################################
-# Debug example (that's wrong now):
+# Calibration example (pick area coordinates for a new card type):
 #
-# handle = StarWarsLureEnhance
-# target_area = 'text'
-# debug_image(IMAGE_PATH, handle, debug=True)
-# debug_image(IMAGE_PATH, handle, target_area=target_area)
-# debug_image(IMAGE_PATH, handle, show_composite=True)
+# ImageProcessingManager(config, IMAGE_PATH, ()).calibrate(
+#     StarWarsLureEnhance
+# ).run("calibration.png")
 ###################################################################
 
 config = Config(